@@ -1,5 +1,7 @@
+import os
 import sys
 import shutil
+import concurrent.futures
 import time
 import datetime
 import tarfile
@@ -14,17 +16,20 @@ import toml
 import re
 from pathlib import Path
 import subprocess
-from . import rules
+from . import helpers, rules
 from .helpers import (
     drv_to_pkg_and_version,
     extract_source,
+    get_release_date,
     get_src,
     log,
     normalize_python_package_name,
+    release_date_cache,
     RuleFunctionOutput,
     RuleOutput,
     RuleOutputCopyFile,
     RuleOutputTriggerExclusion,
+    save_release_date_cache,
 )
 
 import rich.traceback
@@ -306,20 +311,56 @@ def remove_old_logs(project_folder):
         fn.unlink()
 
 
-def strip_ansi_colors(text):
-    return re.sub(r"\x1B(?:[@-Z\\-_]|\[[0-?]*[ -/]*[@-~])", "", text)
+ansi_escape_re = re.compile(rb"\x1B(?:[@-Z\\-_]|\[[0-?]*[ -/]*[@-~])")
+failed_builder_re = re.compile("error: builder for '(/nix/store/[^']+)' failed")
+
+
+def strip_ansi_colors(raw):
+    return ansi_escape_re.sub(b"", raw)
 
 
 def get_nix_log(drv):
+    # strip on the raw bytes, build logs need not be valid utf-8
     return strip_ansi_colors(
-        subprocess.check_output(["nix", "log", drv], text=True, stderr=subprocess.PIPE)
-    )
+        subprocess.check_output(["nix", "log", drv], stderr=subprocess.PIPE)
+    ).decode("utf-8", errors="replace")
+
+
+# the errors rules look for are at the end of a build log - and no error
+# message is this long, those lines are dumped json / minified sources.
+# Both limits count characters of the decoded log.
+max_log_tail = 256_000
+max_log_line = 10_000
+
+
+def prefilter_log(drv, drv_log):
+    """Cut a (decoded) build log down to its last max_log_tail characters,
+    without lines over max_log_line characters - what the rules need to look at"""
+    if len(drv_log) > max_log_tail:
+        log.debug(
+            "Log for %s is %s characters - only matching on the last %s",
+            drv,
+            len(drv_log),
+            max_log_tail,
+        )
+        drv_log = drv_log[-max_log_tail:]
+        drv_log = drv_log[drv_log.find("\n") + 1 :]  # no partial first line
+    if any(len(line) > max_log_line for line in drv_log.split("\n")):
+        log.debug(
+            "Log for %s has lines over %s characters - skipping them",
+            drv,
+            max_log_line,
+        )
+        drv_log = "\n".join(
+            line for line in drv_log.split("\n") if len(line) <= max_log_line
+        )
+    return drv_log
 
 
 def load_failures(project_folder, run_no):
     log_file = project_folder / f"run_{run_no}.log"
-    raw = log_file.read_text()
-    failed_drvs = re.findall("error: builder for '(/nix/store/[^']+)' failed", raw)
+    raw = log_file.read_bytes().decode("utf-8", errors="replace")
+    failed_drvs = failed_builder_re.findall(raw)
     return {drv: get_nix_log(drv) for drv in failed_drvs if not "test-venv" in drv}
 
 
@@ -589,11 +630,61 @@ def copy_if_non_value(value):
         return value
 
 
+def init_rule_worker(manual_rule_path, release_date_cache_path):
+    # spawned (not forked) workers don't inherit what main() set up
+    rules.manual_rule_path = manual_rule_path
+    helpers.release_date_cache_path = release_date_cache_path
+
+
+def match_rules(drv, drv_log, rules_here):
+    """Run all rules on one failed derivation.
+
+    Returns [(rule_name, old_opts, opts)] for the rules that matched, in rule
+    order, and the updated rules_here.
+    Module level, so the process pool can send it to the workers.
+    """
+    matched = []
+    rules.scan_log(drv_log)  # one pass over the log, shared by all rules
+    for rule_name, rule in rules.all_rules():
+        # log.debug(f"checking rule {rule_name} in {drv}")
+        old_opts = rules_here.get(rule_name)
+        if opts := rule.match(
+            drv, drv_log, copy_if_non_value(old_opts), rules_here.copy()
+        ):
+            rules_here[rule_name] = opts
+            matched.append((rule_name, old_opts, opts))
+    return matched, rules_here
+
+
+def prefetch_release_dates(pkg_versions):
+    """BuildSystems needs pypi release dates for packages it already tried cython on.
+
+    Fetch them concurrently (into get_release_date's cache) instead of one
+    request at a time from inside the rule matching, and save them to disk -
+    where the rule workers (and the next run) pick them up"""
+
+    def fetch(pkg_version):
+        try:
+            get_release_date(*pkg_version)
+        except Exception:
+            pass  # not cached - the rule will hit (and report) it again
+
+    if not pkg_versions:
+        return
+    # functools.cache doesn't serialize the first call - load the dict before
+    # the threads race to, or their dates end up in copies that are never saved
+    release_date_cache()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as pool:
+        list(pool.map(fetch, pkg_versions))
+    save_release_date_cache()
+
+
 def detect_rules(project_folder, overrides_folder, failures, current_python):
     """Check which rules we can apply"""
     log.debug(f"Applying rules to {len(failures)} failures")
     any_applied = False
     rules_so_far = {}
+    todo = {}
     for drv, drv_log in failures.items():
         pkg_tuple = drv_to_pkg_and_version(drv)
         if not pkg_tuple[0]:
@@ -608,50 +699,81 @@ def detect_rules(project_folder, overrides_folder, failures, current_python):
             )
             continue
         # is_wheel = check_for_wheel_build(drv)
-        rules_here = load_existing_rules(overrides_folder, *pkg_tuple)
-        for rule_name in dir(rules):
+        todo[drv] = (
+            prefilter_log(drv, drv_log),
+            load_existing_rules(overrides_folder, *pkg_tuple),
+        )
+
+    prefetch_release_dates(
+        {
+            drv_to_pkg_and_version(drv)
+            for drv, (_drv_log, rules_here) in todo.items()
+            if "cython" in rules_here.get("BuildSystems", ())
+        }
+    )
+
+    # the derivations are independent - match them in parallel.
+    # Extraction writes into the overrides folder, so that stays in here.
+    drvs = list(todo)
+    drv_logs = [todo[drv][0] for drv in drvs]
+    old_rules = [todo[drv][1] for drv in drvs]
+    if len(drvs) > 1:
+        # no more workers than drvs - and about four chunks of drvs per worker
+        workers = min(len(drvs), os.cpu_count() or 1)
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=init_rule_worker,
+            initargs=(rules.manual_rule_path, helpers.release_date_cache_path),
+        ) as pool:
+            results = list(
+                pool.map(
+                    match_rules,
+                    drvs,
+                    drv_logs,
+                    old_rules,
+                    chunksize=max(1, len(drvs) // (4 * workers)),
+                )
+            )
+    else:
+        results = list(map(match_rules, drvs, drv_logs, old_rules))
+
+    for drv, (matched, rules_here) in zip(drvs, results):
+        pkg_tuple = drv_to_pkg_and_version(drv)
+        for rule_name, old_opts, opts in matched:
             rule = getattr(rules, rule_name)
+            log.debug(
+                "Got back for rule %s -value: %s - old was %s. Current_python %s",
+                rule,
+                opts,
+                old_opts,
+                current_python,
+            )
             if (
-                isinstance(rule, type)
-                and issubclass(rule, rules.Rule)
-                and rule is not rules.Rule
+                (opts != old_opts)
+                or (opts and hasattr(rule, "always_reapply"))
+                or (
+                    isinstance(rule, type)
+                    and issubclass(rule, rules.DowngradePython)
+                    and (opts != current_python)
+                )
             ):
-                # log.debug(f"checking rule {rule_name} in {pkg_tuple}")
-                old_opts = rules_here.get(rule_name)
-                if opts := rule.match(
-                    drv, drv_log, copy_if_non_value(old_opts), rules_here.copy()
-                ):
-                    log.debug(
-                        f"Got back for rule {rule} -value: {opts} - old was {old_opts}. Current_python {current_python}"
+                any_applied = True
+                log.info(
+                    f"Rule hit! {rule_name} in {pkg_tuple}}}. Now: {opts} - was: {old_opts}"
+                )
+                if hasattr(rule, "extract"):
+                    log.warning(f"Had extract {rule}")
+                    rules_here[rule_name] = (
+                        rules_here[rule_name],
+                        rule.extract(
+                            drv,
+                            overrides_folder
+                            / "overrides"
+                            / pkg_tuple[0]
+                            / pkg_tuple[1],
+                        ),
                     )
 
-                    rules_here[rule_name] = opts
-                    if (
-                        (opts != old_opts)
-                        or (opts and hasattr(rule, "always_reapply"))
-                        or (
-                            isinstance(rule, type)
-                            and issubclass(rule, rules.DowngradePython)
-                            and (opts != current_python)
-                        )
-                    ):
-                        any_applied = True
-                        log.info(
-                            f"Rule hit! {rule_name} in {pkg_tuple}}}. Now: {opts} - was: {old_opts}"
-                        )
-                        if hasattr(rule, "extract"):
-                            log.warning(f"Had extract {rule}")
-                            rules_here[rule_name] = (
-                                rules_here[rule_name],
-                                rule.extract(
-                                    drv,
-                                    overrides_folder
-                                    / "overrides"
-                                    / pkg_tuple[0]
-                                    / pkg_tuple[1],
-                                ),
-                            )
-
         rules_so_far[pkg_tuple] = rules_here
 
     return any_applied, rules_so_far
@@ -860,6 +982,7 @@ def main():
     uv2nix = "github:/adisbladis/uv2nix"
 
     cache_folder = Path(args.cache_folder or ".uv2nix_hammer_cache")
+    helpers.release_date_cache_path = cache_folder / "release_dates.json"
 
     if args.rewrite:
         target_pkg = args.target_pkg
@@ -1,3 +1,5 @@
+import functools
+import os
 import tarfile
 import urllib3
 import logging
@@ -6,8 +8,15 @@ import re
 import toml
 import json
 import subprocess
+from collections import deque
+from pathlib import Path
 from rich.logging import RichHandler
 
+try:
+    import ahocorasick
+except ImportError:  # the "fast" extra - without it, one substring search per trigger
+    ahocorasick = None
+
 FORMAT = "%(message)s"
 logging.basicConfig(
     level="NOTSET", format=FORMAT, datefmt="[%X]", handlers=[RichHandler()]
@@ -17,6 +26,7 @@ log = logging.getLogger("rich")
 log.info("Hello, World!")
 
 
+@functools.lru_cache(maxsize=4096)
 def drv_to_pkg_and_version(drv):
     nix_name = drv.split("/")[-1]
     parts = nix_name[:-4].rsplit("-")
@@ -30,20 +40,48 @@ def drv_to_pkg_and_version(drv):
 
 
 def extract_pyproject_toml_from_archive(src_path, forbidden_paths=None):
-    return toml.loads(search_and_extract_from_archive(src_path, "pyproject.toml", forbidden_paths))
+    """Parsed pyproject.toml from a source archive.
+
+    Cached - the archive lives in the (immutable) nix store, so the path is
+    a sufficient key. Don't modify the returned dict."""
+    return _extract_pyproject_toml_from_archive(
+        src_path, tuple(forbidden_paths) if forbidden_paths else None
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def _extract_pyproject_toml_from_archive(src_path, forbidden_paths):
+    return toml.loads(
+        search_and_extract_from_archive(src_path, "pyproject.toml", forbidden_paths)
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def tar_member_names(src_path):
+    """Names of all members of a .tar.gz.
+
+    Listing has to decompress the whole archive, so we do it once per source"""
+    with tarfile.open(src_path, "r:gz") as tf:
+        return tuple(tf.getnames())
+
+
+@functools.lru_cache(maxsize=None)
+def read_tar_member(src_path, member):
+    with tarfile.open(src_path, "r:gz") as tf:
+        with tf.extractfile(member) as f:
+            return f.read().decode("utf-8")
 
 
 def search_in_archive(src_path, filename):
     if src_path.endswith(".tar.gz"):
-        tf = tarfile.open(src_path, "r:gz")
         candidates = []
-        for fn in tf.getnames():
+        for fn in tar_member_names(src_path):
             if fn.endswith(filename):
                 candidates.append(fn)
         candidates.sort(key=lambda x: len(x))
         if not candidates:
             raise KeyError(f"no {filename}")
-        log.debug(f"Found {candidates[0]} for {filename}")
+        log.debug("Found %s for %s", candidates[0], filename)
         return candidates[0]
     elif src_path.endswith(".zip"):
         # todo: should we not search in this as well?
@@ -64,9 +102,8 @@ def search_and_extract_from_archive(src_path, filename, forbidden_paths=None):
     the one with the shortest overall name is used"""
 
     if src_path.endswith(".tar.gz"):
-        tf = tarfile.open(src_path, "r:gz")
         candidates = []
-        for fn in tf.getnames():
+        for fn in tar_member_names(src_path):
             if fn.endswith(filename):
                 if (not forbidden_paths or not any(
                     [x in str(fn) for x in forbidden_paths]
@@ -75,9 +112,8 @@ def search_and_extract_from_archive(src_path, filename, forbidden_paths=None):
         candidates.sort(key=lambda x: len(x))
         if not candidates:
             raise KeyError(f"no {filename}")
-        log.debug(f"Found {candidates[0]} for {filename}")
-        with tf.extractfile(candidates[0]) as f:
-            return f.read().decode("utf-8")
+        log.debug("Found %s for %s", candidates[0], filename)
+        return read_tar_member(src_path, candidates[0])
     elif src_path.endswith(".zip"):
         # todo: should we not seacrh in this as well?
         with zipfile.ZipFile(src_path) as zf:
@@ -92,21 +128,33 @@ def search_and_extract_from_archive(src_path, filename, forbidden_paths=None):
 
 def has_pyproject_toml(drv):
     try:
-        src = get_src(drv)
-        extract_pyproject_toml_from_archive(src)
-        return True
+        return pyproject_toml_or_none(get_src(drv)) is not None
     except:
         return False
 
 def get_pyproject_toml(drv, forbidden_paths=None):
     src = get_src(drv)
     try:
-        return extract_pyproject_toml_from_archive(src, forbidden_paths)
+        pyproject_toml = pyproject_toml_or_none(src, tuple(forbidden_paths or ()))
     except:
+        pyproject_toml = None
+    if pyproject_toml is None:
         raise KeyError("no pyproject.toml")
+    return pyproject_toml
+
 
+@functools.lru_cache(maxsize=None)
+def pyproject_toml_or_none(src_path, forbidden_paths=()):
+    """Parsed pyproject.toml of a source archive, None if it has none (or is a wheel).
 
+    Unlike extract_pyproject_toml_from_archive, the misses are cached too"""
+    try:
+        return extract_pyproject_toml_from_archive(src_path, forbidden_paths)
+    except (KeyError, ValueError):
+        return None
 
+
+@functools.lru_cache(maxsize=None)
 def get_src(drv):
     derivation = json.loads(
         subprocess.check_output(
@@ -156,25 +204,110 @@ class RuleOutputCopyFile:
 
 
 class Rule:  # marker class for rules
-    pass
+    triggers = ()  # the strings match() looks for in drv_log, see LogScan
+
+
+@functools.cache
+def _all_triggers():
+    return frozenset(
+        trigger for rule in Rule.__subclasses__() for trigger in rule.triggers
+    )
+
+
+@functools.cache
+def _trigger_automaton():
+    if ahocorasick is None:
+        return None
+    automaton = ahocorasick.Automaton()
+    for trigger in _all_triggers():
+        automaton.add_word(trigger, trigger)
+    automaton.make_automaton()
+    return automaton
+
 
+class LogScan:
+    """Which strings occur in a build log.
 
+    All rules' triggers are located in a single pass over the log if
+    pyahocorasick is available. Anything else (or everything, without it)
+    is searched for on first use, and remembered for the following rules.
+    """
+
+    def __init__(self, drv_log):
+        self.drv_log = drv_log
+        self.present = {}
+        self.found = None  # the triggers that hit, if the single pass ran
+        automaton = _trigger_automaton()
+        if automaton is not None:
+            self.found = set()
+            for _end, trigger in automaton.iter(drv_log):
+                self.found.add(trigger)
+            self.present = dict.fromkeys(_all_triggers(), False)
+            self.present.update(dict.fromkeys(self.found, True))
+
+    def __contains__(self, needle):
+        try:
+            return self.present[needle]
+        except KeyError:
+            found = self.present[needle] = needle in self.drv_log
+            return found
+
+    def any(self, needles):
+        return any(needle in self for needle in needles)
+
+
+@functools.lru_cache(maxsize=32)
+def scan_log(drv_log):
+    """The (shared) LogScan of a drv_log - every rule gets to see the same log"""
+    return LogScan(drv_log)
+
+
+release_date_cache_path = None  # set from outside - release dates never change
+
+
+@functools.cache
+def release_date_cache():
+    """{'pkg==version': isoformat release date}, as saved by previous runs"""
+    if release_date_cache_path is None:
+        return {}
+    try:
+        return json.loads(release_date_cache_path.read_text())
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def save_release_date_cache():
+    if release_date_cache_path is None:
+        return
+    release_date_cache_path.parent.mkdir(exist_ok=True, parents=True)
+    temp_path = release_date_cache_path.with_suffix(".tmp")
+    temp_path.write_text(json.dumps(release_date_cache(), indent=0, sort_keys=True))
+    temp_path.replace(release_date_cache_path)
+
+
+@functools.lru_cache(maxsize=None)
 def get_release_date(pkg, version):
     import datetime
 
-    url = f"https://pypi.org/pypi/{pkg}/json"
-    resp = urllib3.request("GET", url)
-    json = resp.json()
-    latest = datetime.datetime(2000, 1, 1)
-    for file in json["releases"][version]:
-        upload_time = datetime.datetime.fromisoformat(file["upload_time"])
-        if upload_time > latest:
-            latest = upload_time
-    return latest
+    key = f"{pkg}=={version}"
+    cache = release_date_cache()
+    if key not in cache:
+        url = f"https://pypi.org/pypi/{pkg}/json"
+        resp = urllib3.request("GET", url)
+        json = resp.json()
+        # pypi's upload_times are uniform ISO timestamps - they sort as strings
+        latest = max(
+            (file["upload_time"] for file in json["releases"][version]), default=None
+        )
+        cache[key] = latest or datetime.datetime(2000, 1, 1).isoformat()
+    return datetime.datetime.fromisoformat(cache[key])
+
+
+package_name_separators_re = re.compile(r"[-_.]+")
 
 
 def normalize_python_package_name(pkg):
-    return re.sub(r"[-_.]+", "-", pkg).lower()
+    return package_name_separators_re.sub("-", pkg).lower()
 
 
 def extract_source(src, target_folder):
@@ -188,3 +321,28 @@ def extract_source(src, target_folder):
         pass
     else:
         log.warn(f"Unknown archive type, not unpacked {src}")
+
+
+# never where a project's own top level manifest lives
+find_shallowest_skip_dirs = frozenset({"target", "vendor", "node_modules"})
+
+
+def find_shallowest(folder, filename):
+    """Breadth first search for filename below folder - the least nested hit wins.
+
+    Skips hidden and build/vendoring directories. Returns None if not found"""
+    todo = deque([folder])
+    while todo:
+        subdirs = []
+        with os.scandir(todo.popleft()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    if not (
+                        entry.name.startswith(".")
+                        or entry.name in find_shallowest_skip_dirs
+                    ):
+                        subdirs.append(entry.path)
+                elif entry.name == filename:
+                    return Path(entry.path)
+        todo.extend(sorted(subdirs))
+    return None
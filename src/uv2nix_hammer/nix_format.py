@@ -1,8 +1,11 @@
 import re
 
 
+nix_identifier_re = re.compile("^[A-Za-z_][A-Za-z0-9-]*$")
+
+
 def nix_identifier(identifier):
-    if re.match("^[A-Za-z_][A-Za-z0-9-]*$", identifier):
+    if nix_identifier_re.match(identifier):
         return identifier
     else:
         return nix_format(identifier)  # format as string
@@ -42,11 +45,14 @@ def nix_format(value):
     elif isinstance(value, list):
         return "[" + " ".join((nix_format(x) for x in value)) + "]"
     else:
-        res = "{"
-        for k, v in sorted(value.items()):
-            res += f"{nix_identifier(k)} = {nix_format(v)};"
-        res += "}"
-        return res
+        return (
+            "{"
+            + "".join(
+                f"{nix_identifier(k)} = {nix_format(v)};"
+                for k, v in sorted(value.items())
+            )
+            + "}"
+        )
 
 
 def main():
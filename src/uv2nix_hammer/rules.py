@@ -1,22 +1,26 @@
-from os import stat
+import os
+import functools
 import subprocess
 import tempfile
 import re
 from .helpers import (
     drv_to_pkg_and_version,
-    extract_pyproject_toml_from_archive,
     extract_source,
+    find_shallowest,
     get_release_date,
     get_src,
     get_pyproject_toml,
     log,
+    pyproject_toml_or_none,
     Rule,
     RuleFunctionOutput,
     RuleOutput,
     RuleOutputCopyFile,
     RuleOutputTriggerExclusion,
+    scan_log,
     search_in_archive,
     search_and_extract_from_archive,
+    tar_member_names,
 )
 import datetime
 from pathlib import Path
@@ -25,14 +29,116 @@ from .nix_format import nix_literal
 
 
 requirements_sep_chars = ">;<=[~"
+requirements_sep_re = re.compile("[" + re.escape(requirements_sep_chars) + "]")
+requirements_sep_set = frozenset(requirements_sep_chars)
+
+# log patterns, compiled once. They are searched unanchored over whole logs,
+# so each starts with a literal (cheap to reject a position) and its [^']
+# classes stop at the closing quote instead of running on through the log.
+attribute_missing_re = re.compile(r"attribute '[^']+' missing")
+final_attribute_re = re.compile(r"final\.[a-z0-9A-Z-]+")
+missing_requirements_txt_re = re.compile(
+    r"No such file or directory: '([^']*requirements\.txt)'"
+)
+python2_except_re = re.compile("except [^,\n]+,[^:\n]+:")
+missing_dependencies_next_line_re = re.compile(
+    "Missing dependencies:[^\n]*\n([^\n]*)"
+)
+
+filtered_build_systems = frozenset(
+    {
+        "hatch-docstring-description",  # not in nixpkgs and useless-for-our-purposes-metadata anyway
+        "setuptools-scm-git-archive",  # marked as broken in nixpkgs, plugin is obsolete, setuptools-scm can do it.
+        "maturin",  # handled by rust below... todo: setuptools-rust
+    }
+)
+
+# substrings BuildSystems looks for after 'Missing dependencies:'.
+# Longest first, so where two start at the same spot the longer one is reported
+missing_dependency_needles_re = re.compile(
+    "|".join(
+        re.escape(x)
+        for x in sorted(
+            [
+                "pytest-runner",
+                "Cython<3,>=0.29.22",
+                "cython<=3",
+                "cython>=3",
+                "Cython>=",
+                "cython>=",
+                "cffi",
+                "numpy;",
+                "numpy>",
+                "numpy=",
+                "pbr>",
+                "certifi>",
+                "versiontools>",
+                "fastrlock",
+                "vcversioner",
+            ],
+            key=len,
+            reverse=True,
+        )
+    )
+)
+
+# lines after 'Missing dependencies:' -> build system to add
+missing_dependency_build_systems = {
+    "setuptools-scm": "setuptools-scm",
+    "setuptools_scm": "setuptools-scm",
+    "setuptools-git": "setuptools-git",
+    "setuptools_git": "setuptools-git",
+    "pycodestyle": "pycodestyle",
+    "isort": "isort",
+    "pip": "pip",
+    "pbr": "pbr",
+    "numpy": "numpy",
+    "wheel": "wheel",
+    "torch": "torch",
+    "ninja": "ninja",
+    "requests": "requests",
+    "flake8": "flake8",
+    "versioneer": "versioneer",
+    "pytest-benchmark": "pytest-benchmark",
+    "sphinx": "sphinx",
+}
 
 
 class BuildSystems(Rule):
+    triggers = (
+        "Cython.Compiler.Errors.CompileError:",
+        "Cython<3,>=0.29.16",
+        "No module named 'setuptools'",
+        "Cannot import 'setuptools.build_meta'",
+        "No module named pip",
+        "RuntimeError: Running cythonize failed!",
+        "Missing dependencies:",
+        "cppyy-cling",
+        "cppyy-backend",
+        "ModuleNotFoundError: No module named 'numpy'",
+        "install requires: 'numpy'",
+        "pip install numpy",
+        "ModuleNotFoundError: No module named 'pandas'",
+        "ModuleNotFoundError: No module named 'convertdate'",
+        "ModuleNotFoundError: No module named 'lunarcalendar'",
+        "ModuleNotFoundError: No module named 'holidays'",
+        "ModuleNotFoundError: No module named 'toml'",
+        "ModuleNotFoundError: No module named 'cffi'",
+        "ModuleNotFoundError: No module named 'pygments'",
+        "No module named 'pybind11'",
+        "ModuleNotFoundError: No module named 'fil3s'",
+        "No matching distribution found for matplotlib",
+        "ModuleNotFoundError: No module named 'Cython'",
+        " No matching distribution found for cython",
+        "error: ‘PyThreadState’ {aka ‘struct _ts’} has no member named ‘exc_traceback’; did you mean ‘curexc_traceback’?",
+        "could not find git for clone of pybind11-populate",
+        "pybind11Config.cmake",
+        "No such file or directory: 'cmake'",
+    )
+
     @staticmethod
     def normalize_build_system(bs):
-        for char in requirements_sep_chars:
-            if char in bs:
-                bs = bs[: bs.index(char)]
+        bs = requirements_sep_re.split(bs, maxsplit=1)[0]
         bs = bs.replace("_", "-")
         return bs.lower().strip()
 
@@ -40,6 +146,9 @@ class BuildSystems(Rule):
     def match(cls, drv, drv_log, opts, _rules_here):
         # the cython3 thing is a debacle.
         pkg, version = drv_to_pkg_and_version(drv)
+        hits = scan_log(drv_log)
+        if opts is not None:
+            opts = set(opts)
         if opts and "cython" in opts:  # -> we already tried it with cython3
             release_date = get_release_date(pkg, version)
             # log.debug(
@@ -52,185 +161,150 @@ class BuildSystems(Rule):
                         2023, 7, 17
                     )  # if it's older than the cython3 release date...
                 )
-                or "Cython.Compiler.Errors.CompileError:" in drv_log
-                or "Cython<3,>=0.29.16" in drv_log
+                or "Cython.Compiler.Errors.CompileError:" in hits
+                or "Cython<3,>=0.29.16" in hits
                 # or "gcc' failed with exit code" in drv_log
             ):
                 log.debug("\tTrying with cython_0")
-                opts.remove("cython")
-                opts.append("cython_0")
+                opts.discard("cython")
+                opts.add("cython_0")
+
+        if opts is not None and not hits.any(cls.triggers):
+            # nothing in the log that would add to what we already had.
+            return cls.tidy(opts, pkg)
 
         if opts is None:  # no build system yet - read pyproject.toml if available..
-            opts = []
+            opts = set()
             try:
-                try:
-                    src = get_src(drv)
-                    pyproject_toml = extract_pyproject_toml_from_archive(src)
-                    # log.debug(f"\tgot pyproject.toml for {drv}")
-                    opts = list(  # sorting is just before return
-                        set(
-                            [
-                                cls.normalize_build_system(x)
-                                for x in pyproject_toml.get("build-system", {}).get(
-                                    "requires", []
-                                )
-                            ]
-                        )
+                pyproject_toml = pyproject_toml_or_none(get_src(drv))
+            except (KeyError, ValueError):
+                pyproject_toml = None
+            if pyproject_toml is not None:
+                # log.debug(f"\tgot pyproject.toml for {drv}")
+                opts = {  # sorting is just before return
+                    cls.normalize_build_system(x)
+                    for x in pyproject_toml.get("build-system", {}).get(
+                        "requires", []
                     )
-                except KeyError:
-                    opts = []
-            except ValueError:
-                opts = []  # was a wheel
+                }
         if (
-            "No module named 'setuptools'" in drv_log
-            or "Cannot import 'setuptools.build_meta'" in drv_log
+            "No module named 'setuptools'" in hits
+            or "Cannot import 'setuptools.build_meta'" in hits
         ):
-            if not "setuptools" in opts:
-                opts.append("setuptools")
-        if "No module named pip" in drv_log and not "pip" in opts:
-            opts.append("pip")
-        if "RuntimeError: Running cythonize failed!" in drv_log and "cython" in opts:
+            opts.add("setuptools")
+        if "No module named pip" in hits:
+            opts.add("pip")
+        if "RuntimeError: Running cythonize failed!" in hits and "cython" in opts:
             log.debug("detected failing cython - trying cython_0")
-            opts.remove("cython")
-            opts.append("cython_0")
-        if "Missing dependencies:" in drv_log:
+            opts.discard("cython")
+            opts.add("cython_0")
+        if "Missing dependencies:" in hits:
             from_here = drv_log[drv_log.find("Missing dependencies:") :]
-            lines = [x.strip() for x in from_here.split("\n")]
+            lines = {x.strip() for x in from_here.split("\n")}
+            found = set(missing_dependency_needles_re.findall(from_here))
             # log.error(f"Missing dependencies - {drv}")
-            if "setuptools-scm" in lines or "setuptools_scm" in lines:
-                opts.append("setuptools-scm")
-            if "setuptools-git" in lines or "setuptools_git" in lines:
-                opts.append("setuptools-git")
+            opts.update(
+                missing_dependency_build_systems[x]
+                for x in lines & missing_dependency_build_systems.keys()
+            )
             # if "setuptools-git-version" in drv_log:
-            #     opts.append("setuptools-git-version") # currently not in nixpkgs
-            if "pytest-runner" in from_here:
-                opts.append("pytest-runner")
-
-            if "pycodestyle" in lines:
-                opts.append("pycodestyle")
-            if "isort" in lines:
-                opts.append("isort")
-            if "Cython<3,>=0.29.22" in from_here or "cython<=3" in from_here:
-                opts.append("cython_0")
-            elif "cython>=3" in from_here:
-                opts.append("cython")
+            #     opts.add("setuptools-git-version") # currently not in nixpkgs
+            if "pytest-runner" in found:
+                opts.add("pytest-runner")
+            if "Cython<3,>=0.29.22" in found or "cython<=3" in found:
+                opts.add("cython_0")
+            elif "cython>=3" in found:
+                opts.add("cython")
             elif (
                 "cython" in lines
                 or "Cython" in lines
-                or "Cython>=" in from_here
-                or "cython>=" in from_here
-            ):
-                opts.append("cython")
-            if "pip" in lines:
-                opts.append("pip")
-            if "pbr" in lines:
-                opts.append("pbr")
-            if "cffi" in from_here:
-                opts.append("cffi")
-            if (
-                "numpy" in lines
-                or "numpy;" in from_here
-                or "numpy>" in from_here
-                or "numpy=" in from_here
+                or "Cython>=" in found
+                or "cython>=" in found
             ):
-                opts.append("numpy")
-            if "wheel" in lines:
-                opts.append("wheel")
-            if "torch" in lines:
-                opts.append("torch")
-            if "ninja" in lines:
-                opts.append("ninja")
-            if "requests" in lines:
-                opts.append("requests")
-            if "pbr>" in from_here:
-                opts.append("pbr")
-            if "certifi>" in from_here:
-                opts.append("certifi")
-            if "versiontools>" in from_here:
-                opts.append("versiontools")
-            if "fastrlock" in from_here:
-                opts.append("fastrlock")
-            if "vcversioner" in from_here:
-                opts.append("vcversioner")
-            if "flake8" in lines:
-                opts.append("flake8")
-            if "versioneer" in lines:
-                opts.append("versioneer")
-            if "pytest-benchmark" in lines:
-                opts.append("pytest-benchmark")
-            if "sphinx" in lines:
-                opts.append("sphinx")
-        if "cppyy-cling" in drv_log:
-            opts.append("cppyy-cling")
-        if "cppyy-backend" in drv_log:
-            opts.append("cppyy-backend")
+                opts.add("cython")
+            if "cffi" in found:
+                opts.add("cffi")
+            if "numpy;" in found or "numpy>" in found or "numpy=" in found:
+                opts.add("numpy")
+            if "pbr>" in found:
+                opts.add("pbr")
+            if "certifi>" in found:
+                opts.add("certifi")
+            if "versiontools>" in found:
+                opts.add("versiontools")
+            if "fastrlock" in found:
+                opts.add("fastrlock")
+            if "vcversioner" in found:
+                opts.add("vcversioner")
+        if "cppyy-cling" in hits:
+            opts.add("cppyy-cling")
+        if "cppyy-backend" in hits:
+            opts.add("cppyy-backend")
         if (
-            "ModuleNotFoundError: No module named 'numpy'" in drv_log
-            or "install requires: 'numpy'" in drv_log
-            or "pip install numpy" in drv_log
+            "ModuleNotFoundError: No module named 'numpy'" in hits
+            or "install requires: 'numpy'" in hits
+            or "pip install numpy" in hits
         ):
-            opts.append("numpy")
-        if "ModuleNotFoundError: No module named 'pandas'" in drv_log:
-            opts.append("pandas")
-        if "ModuleNotFoundError: No module named 'convertdate'" in drv_log:
-            opts.append("convertdate")
-        if "ModuleNotFoundError: No module named 'lunarcalendar'" in drv_log:
-            opts.append("lunarcalendar")
-        if "ModuleNotFoundError: No module named 'holidays'" in drv_log:
-            opts.append("holidays")
-        if "ModuleNotFoundError: No module named 'toml'" in drv_log:
-            opts.append("toml")
-        if "ModuleNotFoundError: No module named 'cffi'" in drv_log:
-            opts.append("cffi")
-        if "ModuleNotFoundError: No module named 'pygments'" in drv_log:
-            opts.append("pygments")
-        if "No module named 'pybind11'" in drv_log:
-            if not "pybind11" in opts:
-                opts.append("pybind11")
-
-        if "ModuleNotFoundError: No module named 'fil3s'" in drv_log:
-            opts.append("fil3s")
-        if "No matching distribution found for matplotlib" in drv_log:
-            opts.append("matplotlib")
+            opts.add("numpy")
+        if "ModuleNotFoundError: No module named 'pandas'" in hits:
+            opts.add("pandas")
+        if "ModuleNotFoundError: No module named 'convertdate'" in hits:
+            opts.add("convertdate")
+        if "ModuleNotFoundError: No module named 'lunarcalendar'" in hits:
+            opts.add("lunarcalendar")
+        if "ModuleNotFoundError: No module named 'holidays'" in hits:
+            opts.add("holidays")
+        if "ModuleNotFoundError: No module named 'toml'" in hits:
+            opts.add("toml")
+        if "ModuleNotFoundError: No module named 'cffi'" in hits:
+            opts.add("cffi")
+        if "ModuleNotFoundError: No module named 'pygments'" in hits:
+            opts.add("pygments")
+        if "No module named 'pybind11'" in hits:
+            opts.add("pybind11")
+
+        if "ModuleNotFoundError: No module named 'fil3s'" in hits:
+            opts.add("fil3s")
+        if "No matching distribution found for matplotlib" in hits:
+            opts.add("matplotlib")
         if (
-            "ModuleNotFoundError: No module named 'Cython'" in drv_log
+            "ModuleNotFoundError: No module named 'Cython'" in hits
         ):  # if you're so old that you don't have a pyproject.toml, but non managed build requirements, you probably also want the old cython,
-            opts.append("cython")
-        opts = [x for x in opts if x != pkg]
+            opts.add("cython")
 
         if not "cython" in opts and not "cython_0" in opts:
             if (
-                "Cython.Compiler.Errors.CompileError:" in drv_log
-                or " No matching distribution found for cython" in drv_log
+                "Cython.Compiler.Errors.CompileError:" in hits
+                or " No matching distribution found for cython" in hits
             ):
-                opts.append("cython")
+                opts.add("cython")
             elif (
                 "error: ‘PyThreadState’ {aka ‘struct _ts’} has no member named ‘exc_traceback’; did you mean ‘curexc_traceback’?"
-                in drv_log
+                in hits
             ):
-                opts.append("cython")
+                opts.add("cython")
 
-        opts = sorted(set(opts))
-        if "poetry" in opts:
-            opts.remove("poetry")
-            opts.append("poetry-core")
-
-        while "cython" in opts and "cython_0" in opts:
-            opts.remove("cython")
         if (
-            "could not find git for clone of pybind11-populate" in drv_log
-            or "pybind11Config.cmake" in drv_log
+            "could not find git for clone of pybind11-populate" in hits
+            or "pybind11Config.cmake" in hits
         ):
-            opts.append("pybind11")
-        if "No such file or directory: 'cmake'" in drv_log:
-            opts.append("cmake")
-        filtered_build_systems = [
-            "hatch-docstring-description",  # not in nixpkgs and useless-for-our-purposes-metadata anyway
-            "setuptools-scm-git-archive",  # marked as broken in nixpkgs, plugin is obsolete, setuptools-scm can do it.
-            "maturin",  # handled by rust below... todo: setuptools-rust
-        ]
-        opts = [x for x in opts if not x in filtered_build_systems]
-        log.debug(f"\tfound build-systems: {opts} (after filtering)")
+            opts.add("pybind11")
+        if "No such file or directory: 'cmake'" in hits:
+            opts.add("cmake")
+        return cls.tidy(opts, pkg)
+
+    @staticmethod
+    def tidy(opts, pkg):
+        opts.discard(pkg)
+        if "poetry" in opts:
+            opts.discard("poetry")
+            opts.add("poetry-core")
+
+        if "cython_0" in opts:
+            opts.discard("cython")
+        opts -= filtered_build_systems
+        opts = sorted(opts)
+        log.debug("\tfound build-systems: %s (after filtering)", opts)
 
         return opts
 
@@ -240,12 +314,14 @@ class BuildSystems(Rule):
 
 
 class PoetryMasonry(Rule):
-    @staticmethod
-    def match(drv, drv_log, opts, _rules_here):
-        return (
-            "ModuleNotFoundError: No module named 'poetry.masonry'" in drv_log
-            or "BackendUnavailable: Cannot import 'poetry.masonry.api'" in drv_log
-        )
+    triggers = (
+        "ModuleNotFoundError: No module named 'poetry.masonry'",
+        "BackendUnavailable: Cannot import 'poetry.masonry.api'",
+    )
+
+    @classmethod
+    def match(cls, drv, drv_log, opts, _rules_here):
+        return scan_log(drv_log).any(cls.triggers)
 
     @staticmethod
     def apply(opts):
@@ -259,9 +335,12 @@ class PoetryMasonry(Rule):
 
 
 class TomlRequiresPatcher(Rule):
+    triggers = ("Missing dependencies:",)
+
     @staticmethod
     def match(drv, drv_log, opts, _rules_here):
-        if "Missing dependencies:" in drv_log:
+        hits = scan_log(drv_log)
+        if "Missing dependencies:" in hits:
             try:
                 pyproject_toml = get_pyproject_toml(
                     drv, forbidden_paths=["third_party"]
@@ -270,10 +349,8 @@ class TomlRequiresPatcher(Rule):
                     "requires" in pyproject_toml
                     or "requires" in pyproject_toml["build-system"]
                 ):
-                    start = drv_log[drv_log.find("Missing dependencies:") :]
-                    next_line = start[start.find("\n") + 1 :]
-                    next_line = next_line[: next_line.find("\n")]
-                    return [x in next_line for x in requirements_sep_chars]
+                    if hit := missing_dependencies_next_line_re.search(drv_log):
+                        return not requirements_sep_set.isdisjoint(hit.group(1))
             except KeyError:
                 pass
 
@@ -289,176 +366,429 @@ class TomlRequiresPatcher(Rule):
         )
 
 
+def bake_native_build_input(x):
+    """Table entry -> the nix_literal that ends up in nativeBuildInputs"""
+    if x.startswith("~literal:!"):
+        return x
+    do_add = not "." in x
+    do_add |= ".dev" in x
+    do_add |= "cudaPackages." in x
+    if x.startswith("pkgs"):
+        do_add = False
+    if do_add:
+        return nix_literal("pkgs." + x)
+    else:
+        return nix_literal(x)
+
+
+# log needle (str or compiled regex) -> package(s) to add to nativeBuildInputs
+native_build_inputs = [
+    (
+        q,
+        tuple(
+            bake_native_build_input(x) for x in ([vs] if isinstance(vs, str) else vs)
+        ),
+    )
+    for q, vs in [
+        ("No such file or directory: 'gfortran'", "gfortran"),
+        (
+            "configure: error: No fortran compiler found, please set the FC flag",
+            "gfortran",
+        ),
+        ("but no Fortran compiler found", "gfortran"),
+        ("No CMAKE_Fortran_COMPILER could be found.", "gfortran"),
+        ("Did not find pkg-config", "pkg-config"),
+        ("pkgconfig", "pkg-config"),
+        ("pkg-config not found", "pkg-config"),
+        ("'pkg-config' is required", "pkg-config"),
+        ("pkg-config: not found", "pkg-config"),
+        ("cannot execute pkg-config", "pkg-config"),
+        ("Install pkg-config.", "pkg-config"),
+        ("missing: PKG_CONFIG_EXECUTABLE", "pkg-config"),
+        ("No such file or directory: 'pkg-config'", "pkg-config"),
+        (
+            "The headers or library files could not be found for zlib",
+            ["zlib.dev", "pkg-config"],
+        ),
+        ("zlib.h: No such file or directory", ["zlib.dev", "pkg-config"]),
+        ("pkg-config is required for building", "pkg-config"),
+        ('"pkg-config" command could not be found.', "pkg-config"),
+        ("CMake must be installed to build from source.", "cmake"),
+        ("Did not find CMake 'cmake'", "cmake"),
+        ("need to install CMake", "cmake"),
+        ("Failed to install temporary CMake", "cmake"),
+        ("CMake is not installed on your system!", "cmake"),
+        ("Missing CMake executable", "cmake"),
+        ("Cannot find CMake executable", "cmake"),
+        ("checking for GTK+ - version >= 3.0.0... no", ["gtk3", "pkg-config"]),
+        ("systemd/sd-daemon.h: No such file", "pkg-config"),  # cysystemd
+        ("cython<1.0.0,>=0.29", "final.cython_0"),
+        ("ModuleNotFoundError: No module named 'mesonpy", "meson"),
+        # setuptools should have been handled by BuildSystems,
+        # so something else must be wrong.
+        # ("ModuleNotFoundError: No module named 'setuptools'", "final.setuptools"),
+        ("gobject-introspection-1.0 found: NO", "gobject-introspection"),
+        ("did not manage to locate a library called 'augeas'", "pkg-config"),
+        ("pkg-config: command not found", "pkg-config"),
+        ("krb5-config", "krb5"),
+        ("libpyvex.so -> not found!", "final.pyvex"),
+        ('#include "cairo.h"', ["pkgs.cairo.dev", "pkg-config"]),
+        (
+            "Specify MYSQLCLIENT_CFLAGS and MYSQLCLIENT_LDFLAGS env vars manually",
+            "libmysqlclient",
+        ),
+        ("ModuleNotFoundError: No module named 'torch'", "final.torch"),
+        ("ta_defs.h: No such file", "ta-lib"),
+        ("Program 'swig' not found or not executable", ["swig"]),
+        (" fatal error: ffi.h: No such file or directory", ["pkg-config"]),
+        (
+            "Unable to locate bz2 library needed when enabling bzip2 support",
+            ["bzip2.dev", "pkg-config"],
+        ),
+        ("bzlib.h: No such file or directory", ["bzip2.dev", "pkg-config"]),
+        ("gmp.h: No such file or directory", ["pkg-config", "gmp.dev"]),
+        ("ModuleNotFoundError: No module named 'pip'", "final.pip"),
+        ("Could not run curl-config", "curl"),
+        ("do you have the `libxml2` development package installed?", "libxml2"),
+        ("cannot get XMLSec1", "pkgs.xmlsec.out"),
+        ("Can not locate liberasurecode.so.1", "pkgs.liberasurecode.dev"),
+        ("Error finding javahome on linux", "pkgs.openjdk"),
+        ("cuda.h: No such file", "cudaPackages.cuda_cudart"),
+        ("sndfile.h: No such file", ["pkgs.libsndfile.dev", "pkg-config"]),
+        ("No such file or directory: 'gdal-config'", "gdal"),
+        ("No such file or directory: 'which'", "which"),
+        ("which: not found", "which"),
+        ("#include <xc.h>", "libxc"),
+        ("#include <notmuch.h>", "notmuch"),
+        (
+            "#include <xkbcommon/xkbcommon.h>",
+            ["pkgs.libxkbcommon.out", "pkgs.libxkbcommon.dev", "pkg-config"],
+        ),
+        ("cannot find -lvapoursynth", "vapoursynth"),
+        ("PyAPI_FUNC(PyCodeObject *) PyCode_New(", "final.cython_0"),
+        ("pcap.h: No such file", "libpcap"),
+        ("lzo1.h: No such file", "lzo"),
+        ("glib.h: No such file", ["pkgs.glib.dev", "pkg-config"]),
+        ("jpeglib.h: No such file", "libjpeg"),
+        ("png.h: No such file", "libpng"),
+        ("tiffio.h: No such file", "libtiff"),
+        ("unrar/dll.hpp: No such", "unrar"),
+        ("iwlib.h: No such file", "wirelesstools"),
+        ("command 'swig' failed: No such file or directory", "swig"),
+        (
+            "Boost Python3 library not found",
+            nix_literal(
+                "(pkgs.boost.override {python = final.python; numpy=final.numpy; enablePython=true;})"
+            ),
+        ),
+        ("Could NOT find GLIB2", "glib"),
+        ("No package 'gfal2' found", "gfal2"),
+        ("Package 'libpcre2-8', required by 'glib-2.0', not found", "pcre2"),
+        ("mpfr.h: No such file", "mpfr"),
+        ("fplll/fplll_config.h: No such file", "fplll_20160331"),
+        ("OSError: mariadb_config not found.", "libmysqlclient"),
+        ("mpi.h: No such file", "mpi"),
+        ("autoreconf: not found", "autoconf"),
+        ("No such file or directory: 'autoreconf'", "autoconf"),
+        ('Can\'t exec "libtoolize"', "libtool"),
+        ('Can\'t exec "aclocal"', "automake"),
+        ("Libtool library used but 'LIBTOOL'", "libtool"),
+        ("glpk.h: No such file", "glpk"),
+        ("could not start gsl-config", "gsl.dev"),
+        ("openssl/ssl.h: No such file", "openssl"),
+        (" openssl/aes.h: No such file", "openssl"),
+        (
+            "sqlite3.h: No such file",
+            "sqlite",
+        ),
+        ("winscard.h: No such file", "pcsclite"),
+        ("hunspell.hxx: No such file", "hunspell.dev"),
+        ("re2/re2.h: No such file", "re2"),
+        ("Eigen/Core: No such file", "eigen"),
+        ("No package 'ddjvuapi' found", "djvulibre"),
+        ("libmilter/mfapi.h: No such file", "libmilter"),
+        ("Error: pg_config executable not found.", "postgresql.dev"),
+        ("cudaProfiler.h: No such", "cudaPackages.cuda_profiler_api"),
+        ("curand.h: No such file", "cudaPackages.libcurand"),
+        ("crt/host_config.h: No such file", "cudaPackages.cuda_nvcc"),
+        ("exiv2/exiv2.hpp: No such fil", "exiv2"),
+        (
+            "boost/python.hpp: No such file",
+            "(pkgs.boost.override {python = final.python; numpy=final.numpy; enablePython=true;})",
+        ),
+        ("libxml/xmlreader.h: No such file or directory", "libxml2.dev"),
+        ("Could NOT find ZLIB", "pkgs.zlib.dev"),
+        # (" Unable to find the blosc2 library.", "c-blosc2"),
+        # ("libxml/xpath.h: No such file or directory", "libxml2"),
+        # (
+        #     "-lldap_r: No such file",
+        #     ["pkgs.openldap.dev", "pkg-config", "cyrus_sasl"],
+        # ),
+        # ("Installing this module requires OpenSSL python bindings", "final.pyopenssl"),
+        # (
+        #     re.compile(
+        #         r"do not know how to unpack source archive [^.\n]+\.zip",
+        #     ),
+        #     "unzip",
+        # ),
+    ]
+]
+
+
+def bake_build_input(pkg):
+    """Table entry -> the nix_literal that ends up in buildInputs"""
+    if pkg.startswith("~literal:!:"):
+        return pkg
+    if not "." in pkg or pkg.startswith("cudaPackages"):
+        return nix_literal(f"pkgs.{pkg}")
+    return nix_literal(pkg)
+
+
+# log needle -> package(s) to add to buildInputs
+build_inputs = [
+    (
+        k,
+        tuple(
+            bake_build_input(x) for x in ([pkgs] if isinstance(pkgs, str) else pkgs)
+        ),
+    )
+    for k, pkgs in [
+        # if 'Dependency "OpenBLAS" not found,' in drv_log:
+        #     opts.append(nix_literal("pkgs.blas"))
+        #     opts.append(nix_literal("pkgs.lapack"))
+        ("error: libhdf5.so: cannot open shared object file", "hdf5"),
+        ("libtbb.so.12 -> not found!", "pkgs.tbb_2021_11.out"),
+        ("libtbb.so.2 -> not found!", "pkgs.tbb.out"),
+        ("zlib.h: No such file or directory", "pkgs.zlib.out"),
+        ("No package 'libswscale' found", "ffmpeg"),
+        ("libtensorflow_framework.so.2 -> not found!", "libtensorflow"),
+        ("libnvJitLink.so.12 -> not found!", "cudaPackages.libnvjitlink"),
+        ("libcublas.so.12 -> not found!", "cudaPackages.libcublas"),
+        ("libcublas.so.11 -> not found!", "cudaPackages_11.libcublas"),
+        ("libcusparse.so.12 -> not found!", "cudaPackages.libcusparse"),
+        ("libcusparse.so.11 -> not found!", "cudaPackages_11.libcusparse"),
+        ("libcusolver.so.11 -> not found!", "cudaPackages.libcusolver"),
+        (
+            "libcudart.so.12 -> not found",
+            nix_literal(
+                '] ++ (pkgs.lib.optionals ((builtins.trace pkgs.stdenv.hostPlatform.system pkgs.stdenv.hostPlatform.system) == "x86_64-linux") [ pkgs.cudaPackages.cuda_cudart ]) ++ ['  # what an ugly hack ^^
+            ),
+        ),
+        ("libcudart.so.11.0 -> not found", "cudaPackages_11.cuda_cudart"),
+        ("libnvrtc.so.12 -> not found!", "cudaPackages.cuda_nvrtc"),
+        ("libcupti.so.12 -> not found!", "cudaPackages.cuda_cupti"),
+        ("libcufft.so.11 -> not found!", "cudaPackages.libcufft"),
+        ("libnvToolsExt.so.1 -> not found!", "cudaPackages.cuda_nvtx"),
+        ("libcurand.so.10 -> not found!", "cudaPackages.libcurand"),
+        (
+            "libcudnn.so.9 -> not found!",
+            "cudaPackages.cudnn",
+        ),  # that means we also need mater...
+        ("cuda.h: No such file", "cudaPackages.cuda_cudart"),
+        # ("cudaProfiler.h", "cudaPackages.cuda_nvml_dev"),
+        ("libnccl.so.2 -> not found!", "cudaPackages.nccl"),
+        (
+            "ld: cannot find -lncurses:",
+            "ncurses",
+        ),  # todo: is that right? that's what poetry2nix did for readline/gnureadline, but it's supposed to be statically linked?
+        ("slurm/spank.h: No such file or directory", "slurm"),
+        ("systemd/sd-daemon.h: No such file", "systemd"),
+        ("libglib-2.0.so.0 -> not found!", "glib"),
+        ("libX11.so.6 -> not found!", "xorg.libX11"),
+        ("libnss3.so -> not found!", "nss"),
+        ("libnssutil3.so -> not found!", "nss"),
+        ("libnspr4.so -> not found!", "nspr"),
+        ("No package 'libsystemd' found", "systemd"),
+        ('Dependency "cairo" not found,', "cairo"),
+        ("did not manage to locate a library called 'augeas'", "augeas"),
+        ("libfreetype.so.6 -> not found!", "freetype"),
+        ("libGLU.so.1 -> not found!", "libGLU"),
+        ("liblzma.so.5 -> not found!", "xz"),
+        ("libxml2.so.2 -> not found!", "libxml2"),
+        ("libSDL2-2.0.so.0 -> not found!", "SDL2"),
+        ("libodbc.so.2 -> not found!", "unixODBC"),
+        ("alsa/asoundlib.h", "pkgs.alsa-lib"),
+        (
+            "Specify MYSQLCLIENT_CFLAGS and MYSQLCLIENT_LDFLAGS env vars manually",
+            "libmysqlclient",
+        ),
+        ("#include <ev.h>", "libev"),
+        ("Is Open Babel installed?", "openbabel"),
+        ("#include <bluetooth/bluetooth.h>", "bluez"),
+        (" #include <boost/optional.hpp>", "boost"),
+        ("/poppler-document.h: No such", "poppler"),
+        ("Could not find required package: opencv.", "opencv4"),
+        ("chm_lib.h: No such file", "chmlib"),  #
+        ("C shared or static library 'blas' not found", "blas"),
+        ("C header 'umfpack.h' not found", "suitesparse"),
+        ("incdir = os.path.relpath(np.get_include())", "final.numpy"),
+        ("libc.musl-x86_64.so.1", "musl"),
+        (" fatal error: ffi.h: No such file or directory", "libffi"),
+        ("lber.h: No such file", ["pkgs.openldap.dev", "pkg-config", "cyrus_sasl"]),
+        ("gmp.h: No such file or directory", ["gmp"]),
+        ("lzma.h: No such file", "pkgs.xz.dev"),
+        ('#include "portaudio.h"', ["portaudio"]),
+        ("cannot get XMLSec1", "pkgs.xmlsec.dev"),
+        ("Can not locate liberasurecode.so.1", "pkgs.liberasurecode.out"),
+        ("Error finding javahome on linux", "pkgs.openjdk"),
+        ("sndfile.h: No such file", "pkgs.libsndfile.out"),
+        ("No such file or directory: 'gdal-config'", "gdal"),
+        ("cannot find -lnotmuch:", "notmuch"),
+        ("#include <xkbcommon/xkbcommon.h>", "pkgs.libxkbcommon.out"),
+        ("libpyvex.so -> not found", "final.pyvex"),  # wheel doesn't declare it...
+        ("libpam.so.0 -> not found!", "linux-pam"),
+        ("libcrypt.so.1 -> not found!", "libxcrypt-legacy"),
+        ("libboost_chrono.so.1.83.0 -> not found!", "boost183"),
+        ("libboost_filesystem.so.1.83.0 -> not found!", "boost183"),
+        ("libboost_python312.so.1.83.0 -> not found!", "boost183"),
+        ("libboost_serialization.so.1.83.0 -> not found!", "boost183"),
+        ("libboost_system.so.1.83.0 -> not found!", "boost183"),
+        (
+            "libboost_python312.so.1.83.0 -> not found!",
+            nix_literal("""
+             (pkgs.boost183.override {
+                 python = final.python;
+                 numpy = final.numpy;
+                 enablePython = true;
+             })
+             """),
+        ),
+        ("Boost library location was not found!", ["boost", "pkg-config"]),
+        ("libconsole_bridge.so.1.0 -> not found!", "console-bridge"),
+        ("libeigenpy.so -> not found!", "final.eigenpy"),
+        ("libhpp-fcl.so -> not found!", "hpp-fcl"),
+        ("liboctomap.so -> not found!", "octomap"),
+        ("liboctomath.so -> not found!", "octomap"),
+        ("libtinyxml.so -> not found!", "tinyxml"),
+        ("liburdfdom_model.so.3.0 -> not found!", "urdfdom"),
+        ("liburdfdom_sensor.so.3.0 -> not found!", "urdfdom"),
+        ("liburdfdom_world.so.3.0 -> not found!", "urdfdom"),
+        ("libassimp.so.5 -> not found!", "assimp"),
+        ("libqhull_r.so.8.0 -> not found!", "qhull"),
+        ("libudev.so.1 -> not found!", "udev"),
+        ("glib.h: No such file", "glib"),
+        ("crack.h: No such file", "cracklib"),
+        ("libjvm.so", "openjdk"),
+        ("udunits2.h: No such file", "udunits"),
+        ("libprecice not found", "precice"),
+        (
+            " cups/http.h: No such file",
+            "cups",
+        ),  # libiconv on darwin, but needs extension here.
+        ("libOpenCL.so.1 -> not found!", "ocl-icd"),
+        ("libze_loader.so.1 -> not found!", "level-zero"),
+        ("Could NOT find OpenSSL", "openssl"),
+        ("graphviz/cgraph.h: No such file", "graphviz"),
+        ("-lz: No such file", "zlib"),
+        ("libssl.so.1.1 -> not found!", "openssl_1_1"),
+        ("libcrypto.so.1.1 -> not found!", "openssl_1_1"),
+        ("libz.so.1 -> not found!", "zlib"),
+        ("libkeyutils.so.1", "keyutils"),
+        ("sasl/sasl.h: No such file", "cyrus_sasl"),
+        ("Installing gifsicle on Linux requires sudo!", "gifsicle"),
+        ("could not start gsl-config", "gsl"),
+        ("libhwloc.so.15 -> not found!", "hwloc"),
+        # (" RequiredDependencyException: pangocairo", "pango"),
+        ("libexiv2.so.28 -> not found!", "exiv2"),
+        ("libpcsclite.so.1 -> not found", "pcsclite"),
+        ("libcurl.so.4 -> not found!", "curl"),
+        ("libssl.so.3 -> not found!", "openssl"),
+        (
+            "libgfortran.so.5 -> not found!",
+            [
+                nix_literal("pkgs.gfortran13.cc"),
+                nix_literal("pkgs.gfortran13.out"),
+            ],
+        ),
+        ("cannot find -lhunspell", "pkgs.hunspell.out"),
+        ("Failed to find Gammu!", "gammu"),
+        ("libXcursor.so.1 -> not found!", "pkgs.xorg.libXcursor"),
+        ("libXfixes.so.3 -> not found!", "pkgs.xorg.libXfixes"),
+        ("libXft.so.2 -> not found!", "pkgs.xorg.libXft"),
+        ("libfontconfig.so.1 -> not found!", "pkgs.fontconfig"),
+        ("libXinerama.so.1 -> not found!", "pkgs.xorg.libXinerama"),
+        ("libkrb5.so.3 -> not found!", "krb5"),
+        ("Could NOT find BLAS", ["blas", "lapack"]),
+        ("openblas", ["openblas", "pkg-config"]),
+        ("umfpack", ["suitesparse"]),
+        ("pull submodule rabbitmq-c.", "rabbitmq-c"),
+        ("libdbus-1.so.3 -> not found!", "dbus"),
+        ("libusb-1.0.so.0 -> not found!", "libusb1"),
+        ("libbluetooth.so.3 -> not found!", "bluez"),
+        ("libgtk-x11-2.0.so.0", ["gtk2", "pkg-config"]),
+        ("libcairo.so.2 -> not found!", "cairo"),
+        ("libpango-1.0.so.0 -> not found!", "pango"),
+        ("mysql_config not found", "libmysqlclient"),
+        ("libnl-3.so.200 -> not found!", "libnl"),
+    ]
+]
+
+
+def group_by_target(table):
+    """{targets: [needles]} - so one hit settles all needles for the same packages"""
+    groups = {}
+    for needle, targets in table:
+        if isinstance(needle, str):
+            groups.setdefault(targets, []).append(needle)
+    return groups
+
+
+def group_by_needle(table):
+    """{needle: targets} - a needle may be listed more than once"""
+    groups = {}
+    for needle, targets in table:
+        if isinstance(needle, str):
+            groups[needle] = groups.get(needle, ()) + targets
+    return groups
+
+
+native_build_inputs_by_target = group_by_target(native_build_inputs)
+build_inputs_by_target = group_by_target(build_inputs)
+native_build_inputs_by_needle = group_by_needle(native_build_inputs)
+build_inputs_by_needle = group_by_needle(build_inputs)
+native_build_inputs_regexes = [
+    (q, vs) for q, vs in native_build_inputs if not isinstance(q, str)
+]
+
+
+def lookup_inputs(hits, by_target, by_needle):
+    """Union of the targets whose needles occur in the log"""
+    found = set()
+    if hits.found is not None:
+        # the single pass already knows which needles hit - only visit those
+        for needle in hits.found.intersection(by_needle):
+            found.update(by_needle[needle])
+    else:
+        for targets, needles in by_target.items():
+            if hits.any(needles):
+                found.update(targets)
+    return found
+
+
+@functools.lru_cache(maxsize=32)
+def match_inputs(drv_log):
+    """(nativeBuildInputs, buildInputs) the tables ask for on this drv_log.
+
+    Both tables are answered from the one shared scan_log pass."""
+    hits = scan_log(drv_log)
+    native = lookup_inputs(
+        hits, native_build_inputs_by_target, native_build_inputs_by_needle
+    )
+    for q, vs in native_build_inputs_regexes:
+        if q.search(drv_log):
+            native.update(vs)
+    build = lookup_inputs(hits, build_inputs_by_target, build_inputs_by_needle)
+    return frozenset(native), frozenset(build)
+
+
 class NativeBuildInputs(Rule):
+    triggers = tuple(q for q, _ in native_build_inputs if isinstance(q, str))
+
     @staticmethod
     def match(drv, drv_log, opts, _rules_here):
-        if opts is None:
-            opts = []
-
-        def add_pkgs(x):
-            if x.startswith("~literal:!"):
-                return x[11:]
-            do_add = not "." in x
-            do_add |= ".dev" in x
-            do_add |= "cudaPackages." in x
-            if x.startswith("pkgs"):
-                do_add = False
-            if do_add:
-                return "pkgs." + x
-            else:
-                return x
-
-        for q, vs in [
-            ("No such file or directory: 'gfortran'", "gfortran"),
-            (
-                "configure: error: No fortran compiler found, please set the FC flag",
-                "gfortran",
-            ),
-            ("but no Fortran compiler found", "gfortran"),
-            ("No CMAKE_Fortran_COMPILER could be found.", "gfortran"),
-            ("Did not find pkg-config", "pkg-config"),
-            ("pkgconfig", "pkg-config"),
-            ("pkg-config not found", "pkg-config"),
-            ("'pkg-config' is required", "pkg-config"),
-            ("pkg-config: not found", "pkg-config"),
-            ("cannot execute pkg-config", "pkg-config"),
-            ("Install pkg-config.", "pkg-config"),
-            ("missing: PKG_CONFIG_EXECUTABLE", "pkg-config"),
-            ("No such file or directory: 'pkg-config'", "pkg-config"),
-            (
-                "The headers or library files could not be found for zlib",
-                ["zlib.dev", "pkg-config"],
-            ),
-            ("zlib.h: No such file or directory", ["zlib.dev", "pkg-config"]),
-            ("pkg-config is required for building", "pkg-config"),
-            ('"pkg-config" command could not be found.', "pkg-config"),
-            ("CMake must be installed to build from source.", "cmake"),
-            ("Did not find CMake 'cmake'", "cmake"),
-            ("need to install CMake", "cmake"),
-            ("Failed to install temporary CMake", "cmake"),
-            ("CMake is not installed on your system!", "cmake"),
-            ("Missing CMake executable", "cmake"),
-            ("Cannot find CMake executable", "cmake"),
-            ("checking for GTK+ - version >= 3.0.0... no", ["gtk3", "pkg-config"]),
-            ("systemd/sd-daemon.h: No such file", "pkg-config"),  # cysystemd
-            ("cython<1.0.0,>=0.29", "final.cython_0"),
-            ("ModuleNotFoundError: No module named 'mesonpy", "meson"),
-            # setuptools should have been handled by BuildSystems,
-            # so something else must be wrong.
-            # ("ModuleNotFoundError: No module named 'setuptools'", "final.setuptools"),
-            ("gobject-introspection-1.0 found: NO", "gobject-introspection"),
-            ("did not manage to locate a library called 'augeas'", "pkg-config"),
-            ("pkg-config: command not found", "pkg-config"),
-            ("krb5-config", "krb5"),
-            ("libpyvex.so -> not found!", "final.pyvex"),
-            ('#include "cairo.h"', ["pkgs.cairo.dev", "pkg-config"]),
-            (
-                "Specify MYSQLCLIENT_CFLAGS and MYSQLCLIENT_LDFLAGS env vars manually",
-                "libmysqlclient",
-            ),
-            ("ModuleNotFoundError: No module named 'torch'", "final.torch"),
-            ("ta_defs.h: No such file", "ta-lib"),
-            ("Program 'swig' not found or not executable", ["swig"]),
-            (" fatal error: ffi.h: No such file or directory", ["pkg-config"]),
-            (
-                "Unable to locate bz2 library needed when enabling bzip2 support",
-                ["bzip2.dev", "pkg-config"],
-            ),
-            ("bzlib.h: No such file or directory", ["bzip2.dev", "pkg-config"]),
-            ("gmp.h: No such file or directory", ["pkg-config", "gmp.dev"]),
-            ("ModuleNotFoundError: No module named 'pip'", "final.pip"),
-            ("Could not run curl-config", "curl"),
-            ("do you have the `libxml2` development package installed?", "libxml2"),
-            ("cannot get XMLSec1", "pkgs.xmlsec.out"),
-            ("Can not locate liberasurecode.so.1", "pkgs.liberasurecode.dev"),
-            ("Error finding javahome on linux", "pkgs.openjdk"),
-            ("cuda.h: No such file", "cudaPackages.cuda_cudart"),
-            ("sndfile.h: No such file", ["pkgs.libsndfile.dev", "pkg-config"]),
-            ("No such file or directory: 'gdal-config'", "gdal"),
-            ("No such file or directory: 'which'", "which"),
-            ("which: not found", "which"),
-            ("#include <xc.h>", "libxc"),
-            ("#include <notmuch.h>", "notmuch"),
-            (
-                "#include <xkbcommon/xkbcommon.h>",
-                ["pkgs.libxkbcommon.out", "pkgs.libxkbcommon.dev", "pkg-config"],
-            ),
-            ("cannot find -lvapoursynth", "vapoursynth"),
-            ("PyAPI_FUNC(PyCodeObject *) PyCode_New(", "final.cython_0"),
-            ("pcap.h: No such file", "libpcap"),
-            ("lzo1.h: No such file", "lzo"),
-            ("glib.h: No such file", ["pkgs.glib.dev", "pkg-config"]),
-            ("jpeglib.h: No such file", "libjpeg"),
-            ("png.h: No such file", "libpng"),
-            ("tiffio.h: No such file", "libtiff"),
-            ("unrar/dll.hpp: No such", "unrar"),
-            ("iwlib.h: No such file", "wirelesstools"),
-            ("command 'swig' failed: No such file or directory", "swig"),
-            (
-                "Boost Python3 library not found",
-                nix_literal(
-                    "(pkgs.boost.override {python = final.python; numpy=final.numpy; enablePython=true;})"
-                ),
-            ),
-            ("Could NOT find GLIB2", "glib"),
-            ("No package 'gfal2' found", "gfal2"),
-            ("Package 'libpcre2-8', required by 'glib-2.0', not found", "pcre2"),
-            ("mpfr.h: No such file", "mpfr"),
-            ("fplll/fplll_config.h: No such file", "fplll_20160331"),
-            ("OSError: mariadb_config not found.", "libmysqlclient"),
-            ("mpi.h: No such file", "mpi"),
-            ("autoreconf: not found", "autoconf"),
-            ("No such file or directory: 'autoreconf'", "autoconf"),
-            ('Can\'t exec "libtoolize"', "libtool"),
-            ('Can\'t exec "aclocal"', "automake"),
-            ("Libtool library used but 'LIBTOOL'", "libtool"),
-            ("glpk.h: No such file", "glpk"),
-            ("could not start gsl-config", "gsl.dev"),
-            ("openssl/ssl.h: No such file", "openssl"),
-            (" openssl/aes.h: No such file", "openssl"),
-            (
-                "sqlite3.h: No such file",
-                "sqlite",
-            ),
-            ("winscard.h: No such file", "pcsclite"),
-            ("hunspell.hxx: No such file", "hunspell.dev"),
-            ("re2/re2.h: No such file", "re2"),
-            ("Eigen/Core: No such file", "eigen"),
-            ("No package 'ddjvuapi' found", "djvulibre"),
-            ("libmilter/mfapi.h: No such file", "libmilter"),
-            ("Error: pg_config executable not found.", "postgresql.dev"),
-            ("cudaProfiler.h: No such", "cudaPackages.cuda_profiler_api"),
-            ("curand.h: No such file", "cudaPackages.libcurand"),
-            ("crt/host_config.h: No such file", "cudaPackages.cuda_nvcc"),
-            ("exiv2/exiv2.hpp: No such fil", "exiv2"),
-            (
-                "boost/python.hpp: No such file",
-                "(pkgs.boost.override {python = final.python; numpy=final.numpy; enablePython=true;})",
-            ),
-            ("libxml/xmlreader.h: No such file or directory", "libxml2.dev"),
-            ("Could NOT find ZLIB", "pkgs.zlib.dev"),
-            # (" Unable to find the blosc2 library.", "c-blosc2"),
-            # ("libxml/xpath.h: No such file or directory", "libxml2"),
-            # (
-            #     "-lldap_r: No such file",
-            #     ["pkgs.openldap.dev", "pkg-config", "cyrus_sasl"],
-            # ),
-            # ("Installing this module requires OpenSSL python bindings", "final.pyopenssl"),
-            # (
-            #     re.compile(
-            #         "do not know how to unpack source archive [^.]+.zip",
-            #     ),
-            #     "unzip",
-            # ),
-        ]:
-            is_str = isinstance(q, str)
-            if (is_str and q in drv_log) or (not is_str and q.search(drv_log)):
-                if not isinstance(vs, list):
-                    vs = [vs]
-                for x in vs:
-                    opts.append(nix_literal(add_pkgs(x)))
-
-        return sorted(set(opts))
+        opts = set(opts or ())
+        opts.update(match_inputs(drv_log)[0])
+        return sorted(opts)
 
     @staticmethod
     def apply(opts):
@@ -475,18 +805,18 @@ class NativeBuildInputs(Rule):
         if nix_literal("pkgs.cmake") in opts or "pkgs.meson" in opts:
             src_attrset["dontUseCmakeConfigure"] = True
 
-        args = sorted(
-            set(x[len("~literal:!:") :].split(".")[0] for x in opts if "." in x)
-        )
-        args = [x for x in args if x[0] != "("]
+        args = {x[len("~literal:!:") :].split(".", 1)[0] for x in opts if "." in x}
+        args = sorted(x for x in args if x[0] != "(")
         return RuleOutput(arguments=args, src_attrset_parts=src_attrset)
 
 
 class BorkedRuntimeDepsCheck(Rule):
+    triggers = ("not satisfied by version",)
+
     @staticmethod
     def match(drv, drv_log, opts, _rules_here):
         # todo: make this less generic?
-        return "not satisfied by version" in drv_log
+        return "not satisfied by version" in scan_log(drv_log)
 
     @staticmethod
     def apply(opts):
@@ -495,222 +825,45 @@ class BorkedRuntimeDepsCheck(Rule):
 
 
 class BuildInputs(Rule):
+    triggers = tuple(k for k, _ in build_inputs)
+
     @staticmethod
     def match(drv, drv_log, opts, _rules_here):
-        if opts is None:
-            opts = []
-        # if 'Dependency "OpenBLAS" not found,' in drv_log:
-        #     opts.append(nix_literal("pkgs.blas"))
-        #     opts.append(nix_literal("pkgs.lapack"))
-        for k, pkgs in [
-            ("error: libhdf5.so: cannot open shared object file", "hdf5"),
-            ("libtbb.so.12 -> not found!", "pkgs.tbb_2021_11.out"),
-            ("libtbb.so.2 -> not found!", "pkgs.tbb.out"),
-            ("zlib.h: No such file or directory", "pkgs.zlib.out"),
-            ("No package 'libswscale' found", "ffmpeg"),
-            ("libtensorflow_framework.so.2 -> not found!", "libtensorflow"),
-            ("libnvJitLink.so.12 -> not found!", "cudaPackages.libnvjitlink"),
-            ("libcublas.so.12 -> not found!", "cudaPackages.libcublas"),
-            ("libcublas.so.11 -> not found!", "cudaPackages_11.libcublas"),
-            ("libcusparse.so.12 -> not found!", "cudaPackages.libcusparse"),
-            ("libcusparse.so.11 -> not found!", "cudaPackages_11.libcusparse"),
-            ("libcusolver.so.11 -> not found!", "cudaPackages.libcusolver"),
-            (
-                "libcudart.so.12 -> not found",
-                nix_literal(
-                    '] ++ (pkgs.lib.optionals ((builtins.trace pkgs.stdenv.hostPlatform.system pkgs.stdenv.hostPlatform.system) == "x86_64-linux") [ pkgs.cudaPackages.cuda_cudart ]) ++ ['  # what an ugly hack ^^
-                ),
-            ),
-            ("libcudart.so.11.0 -> not found", "cudaPackages_11.cuda_cudart"),
-            ("libnvrtc.so.12 -> not found!", "cudaPackages.cuda_nvrtc"),
-            ("libcupti.so.12 -> not found!", "cudaPackages.cuda_cupti"),
-            ("libcufft.so.11 -> not found!", "cudaPackages.libcufft"),
-            ("libnvToolsExt.so.1 -> not found!", "cudaPackages.cuda_nvtx"),
-            ("libcurand.so.10 -> not found!", "cudaPackages.libcurand"),
-            (
-                "libcudnn.so.9 -> not found!",
-                "cudaPackages.cudnn",
-            ),  # that means we also need mater...
-            ("cuda.h: No such file", "cudaPackages.cuda_cudart"),
-            # ("cudaProfiler.h", "cudaPackages.cuda_nvml_dev"),
-            ("libnccl.so.2 -> not found!", "cudaPackages.nccl"),
-            (
-                "ld: cannot find -lncurses:",
-                "ncurses",
-            ),  # todo: is that right? that's what poetry2nix did for readline/gnureadline, but it's supposed to be statically linked?
-            ("slurm/spank.h: No such file or directory", "slurm"),
-            ("systemd/sd-daemon.h: No such file", "systemd"),
-            ("libglib-2.0.so.0 -> not found!", "glib"),
-            ("libX11.so.6 -> not found!", "xorg.libX11"),
-            ("libnss3.so -> not found!", "nss"),
-            ("libnssutil3.so -> not found!", "nss"),
-            ("libnspr4.so -> not found!", "nspr"),
-            ("No package 'libsystemd' found", "systemd"),
-            ('Dependency "cairo" not found,', "cairo"),
-            ("did not manage to locate a library called 'augeas'", "augeas"),
-            ("libfreetype.so.6 -> not found!", "freetype"),
-            ("libGLU.so.1 -> not found!", "libGLU"),
-            ("liblzma.so.5 -> not found!", "xz"),
-            ("libxml2.so.2 -> not found!", "libxml2"),
-            ("libSDL2-2.0.so.0 -> not found!", "SDL2"),
-            ("libodbc.so.2 -> not found!", "unixODBC"),
-            ("alsa/asoundlib.h", "pkgs.alsa-lib"),
-            (
-                "Specify MYSQLCLIENT_CFLAGS and MYSQLCLIENT_LDFLAGS env vars manually",
-                "libmysqlclient",
-            ),
-            ("#include <ev.h>", "libev"),
-            ("Is Open Babel installed?", "openbabel"),
-            ("#include <bluetooth/bluetooth.h>", "bluez"),
-            (" #include <boost/optional.hpp>", "boost"),
-            ("/poppler-document.h: No such", "poppler"),
-            ("Could not find required package: opencv.", "opencv4"),
-            ("chm_lib.h: No such file", "chmlib"),  #
-            ("C shared or static library 'blas' not found", "blas"),
-            ("C header 'umfpack.h' not found", "suitesparse"),
-            ("incdir = os.path.relpath(np.get_include())", "final.numpy"),
-            ("libc.musl-x86_64.so.1", "musl"),
-            (" fatal error: ffi.h: No such file or directory", "libffi"),
-            ("lber.h: No such file", ["pkgs.openldap.dev", "pkg-config", "cyrus_sasl"]),
-            ("gmp.h: No such file or directory", ["gmp"]),
-            ("lzma.h: No such file", "pkgs.xz.dev"),
-            ('#include "portaudio.h"', ["portaudio"]),
-            ("cannot get XMLSec1", "pkgs.xmlsec.dev"),
-            ("Can not locate liberasurecode.so.1", "pkgs.liberasurecode.out"),
-            ("Error finding javahome on linux", "pkgs.openjdk"),
-            ("sndfile.h: No such file", "pkgs.libsndfile.out"),
-            ("No such file or directory: 'gdal-config'", "gdal"),
-            ("cannot find -lnotmuch:", "notmuch"),
-            ("#include <xkbcommon/xkbcommon.h>", "pkgs.libxkbcommon.out"),
-            ("libpyvex.so -> not found", "final.pyvex"),  # wheel doesn't declare it...
-            ("libpam.so.0 -> not found!", "linux-pam"),
-            ("libcrypt.so.1 -> not found!", "libxcrypt-legacy"),
-            ("libboost_chrono.so.1.83.0 -> not found!", "boost183"),
-            ("libboost_filesystem.so.1.83.0 -> not found!", "boost183"),
-            ("libboost_python312.so.1.83.0 -> not found!", "boost183"),
-            ("libboost_serialization.so.1.83.0 -> not found!", "boost183"),
-            ("libboost_system.so.1.83.0 -> not found!", "boost183"),
-            (
-                "libboost_python312.so.1.83.0 -> not found!",
-                nix_literal("""
-             (pkgs.boost183.override {
-                 python = final.python;
-                 numpy = final.numpy;
-                 enablePython = true;
-             })
-             """),
-            ),
-            ("Boost library location was not found!", ["boost", "pkg-config"]),
-            ("libconsole_bridge.so.1.0 -> not found!", "console-bridge"),
-            ("libeigenpy.so -> not found!", "final.eigenpy"),
-            ("libhpp-fcl.so -> not found!", "hpp-fcl"),
-            ("liboctomap.so -> not found!", "octomap"),
-            ("liboctomath.so -> not found!", "octomap"),
-            ("libtinyxml.so -> not found!", "tinyxml"),
-            ("liburdfdom_model.so.3.0 -> not found!", "urdfdom"),
-            ("liburdfdom_sensor.so.3.0 -> not found!", "urdfdom"),
-            ("liburdfdom_world.so.3.0 -> not found!", "urdfdom"),
-            ("libassimp.so.5 -> not found!", "assimp"),
-            ("libqhull_r.so.8.0 -> not found!", "qhull"),
-            ("libudev.so.1 -> not found!", "udev"),
-            ("glib.h: No such file", "glib"),
-            ("crack.h: No such file", "cracklib"),
-            ("libjvm.so", "openjdk"),
-            ("udunits2.h: No such file", "udunits"),
-            ("libprecice not found", "precice"),
-            (
-                " cups/http.h: No such file",
-                "cups",
-            ),  # libiconv on darwin, but needs extension here.
-            ("libOpenCL.so.1 -> not found!", "ocl-icd"),
-            ("libze_loader.so.1 -> not found!", "level-zero"),
-            ("Could NOT find OpenSSL", "openssl"),
-            ("graphviz/cgraph.h: No such file", "graphviz"),
-            ("-lz: No such file", "zlib"),
-            ("libssl.so.1.1 -> not found!", "openssl_1_1"),
-            ("libcrypto.so.1.1 -> not found!", "openssl_1_1"),
-            ("libz.so.1 -> not found!", "zlib"),
-            ("libkeyutils.so.1", "keyutils"),
-            ("sasl/sasl.h: No such file", "cyrus_sasl"),
-            ("Installing gifsicle on Linux requires sudo!", "gifsicle"),
-            ("could not start gsl-config", "gsl"),
-            ("libhwloc.so.15 -> not found!", "hwloc"),
-            # (" RequiredDependencyException: pangocairo", "pango"),
-            ("libexiv2.so.28 -> not found!", "exiv2"),
-            ("libpcsclite.so.1 -> not found", "pcsclite"),
-            ("libcurl.so.4 -> not found!", "curl"),
-            ("libssl.so.3 -> not found!", "openssl"),
-            (
-                "libgfortran.so.5 -> not found!",
-                [
-                    nix_literal("pkgs.gfortran13.cc"),
-                    nix_literal("pkgs.gfortran13.out"),
-                ],
-            ),
-            ("cannot find -lhunspell", "pkgs.hunspell.out"),
-            ("Failed to find Gammu!", "gammu"),
-            ("libXcursor.so.1 -> not found!", "pkgs.xorg.libXcursor"),
-            ("libXfixes.so.3 -> not found!", "pkgs.xorg.libXfixes"),
-            ("libXft.so.2 -> not found!", "pkgs.xorg.libXft"),
-            ("libfontconfig.so.1 -> not found!", "pkgs.fontconfig"),
-            ("libXinerama.so.1 -> not found!", "pkgs.xorg.libXinerama"),
-            ("libkrb5.so.3 -> not found!", "krb5"),
-            ("Could NOT find BLAS", ["blas", "lapack"]),
-            ("openblas", ["openblas", "pkg-config"]),
-            ("umfpack", ["suitesparse"]),
-            ("pull submodule rabbitmq-c.", "rabbitmq-c"),
-            ("libdbus-1.so.3 -> not found!", "dbus"),
-            ("libusb-1.0.so.0 -> not found!", "libusb1"),
-            ("libbluetooth.so.3 -> not found!", "bluez"),
-            ("libgtk-x11-2.0.so.0", ["gtk2", "pkg-config"]),
-            ("libcairo.so.2 -> not found!", "cairo"),
-            ("libpango-1.0.so.0 -> not found!", "pango"),
-            ("mysql_config not found", "libmysqlclient"),
-            ("libnl-3.so.200 -> not found!", "libnl"),
-        ]:
-            if k in drv_log:
-                if isinstance(pkgs, str):
-                    pkgs = [pkgs]
-                for pkg in pkgs:
-                    if not pkg.startswith("~literal:!:"):
-                        if not "." in pkg or pkg.startswith("cudaPackages"):
-                            opts.append(nix_literal(f"pkgs.{pkg}"))
-                        else:
-                            opts.append(nix_literal(pkg))
-                    else:
-                        opts.append(pkg)
-
-        return sorted(set(opts))
+        opts = set(opts or ())
+        opts.update(match_inputs(drv_log)[1])
+        return sorted(opts)
 
     @staticmethod
     def apply(opts):
-        if "pkgs.slurm" in opts:
+        opts_set = set(opts)
+        if "pkgs.slurm" in opts_set:
             env = {
                 "SLURM_LIB_DIR": "${lib.getLib slurm}/lib",
                 "SLURM_INCLUDE_DIR": "${lib.getDev slurm}/include",
             }
         else:
             env = {}
-        needs_master = nix_literal("pkgs.cudaPackages.cudnn") in opts
+        needs_master = nix_literal("pkgs.cudaPackages.cudnn") in opts_set
         if needs_master:
             log.debug("Switching to master because of cuda")
         arguments = {"pkgs"}
-        fixups = ""
-        for pkg in opts:
-            if pkg.startswith("~literal:!:final."):
-                pkg_str = pkg[len("~literal:!:final.") :]
-                cmeel_packages = ["eigenpy"]
-                if pkg_str in cmeel_packages:
-                    # no clue why the place the .so files there.
-                    fixups += f"addAutoPatchelfSearchPath ${{final.{pkg_str}}}/${{final.python.sitePackages}}/cmeel.prefix/${{final.python.sitePackages}}\n"
-                else:
-                    fixups += f"addAutoPatchelfSearchPath ${{final.{pkg_str}}}/${{final.python.sitePackages}}/{pkg_str}/lib\n"
-                arguments.add("final")
-            if pkg == "~literal:!:pkgs.openjdk":
-                pkg_str = pkg[len("~literal:!:") :]
-                fixups += f"addAutoPatchelfSearchPath ${{{pkg_str}}}/lib/openjdk/lib/server/\n"
-            if "final." in pkg:
-                arguments.add("final")
+        if any("final." in pkg for pkg in opts):
+            arguments.add("final")
+        final_pkgs = [
+            pkg[len("~literal:!:final.") :]
+            for pkg in opts
+            if pkg.startswith("~literal:!:final.")
+        ]
+        cmeel_packages = ["eigenpy"]
+        fixups = "".join(
+            # no clue why the place the .so files there.
+            f"addAutoPatchelfSearchPath ${{final.{pkg_str}}}/${{final.python.sitePackages}}/cmeel.prefix/${{final.python.sitePackages}}\n"
+            if pkg_str in cmeel_packages
+            else f"addAutoPatchelfSearchPath ${{final.{pkg_str}}}/${{final.python.sitePackages}}/{pkg_str}/lib\n"
+            for pkg_str in final_pkgs
+        )
+        if "~literal:!:pkgs.openjdk" in opts_set:
+            fixups += "addAutoPatchelfSearchPath ${pkgs.openjdk}/lib/openjdk/lib/server/\n"
         src_attr_parts = {"buildInputs": opts, "env": env}
         wheel_attr_parts = {"buildInputs": opts}
         if fixups:
@@ -760,6 +913,24 @@ class MasterForTorch(Rule):  # torch requires nixpkgs master.
 manual_rule_path = None  # set from outside
 
 
+@functools.lru_cache(maxsize=None)
+def list_manual_override_folder(folder):
+    """Files in a manual_overrides/pkg/version folder.
+
+    Cached - the manual overrides are in place before we start matching.
+    """
+    try:
+        return tuple(sorted(folder.iterdir()))
+    except FileNotFoundError:
+        return ()
+
+
+@functools.lru_cache(maxsize=None)
+def read_manual_override(path):
+    """Contents of a manual_overrides default.nix - cached like the listing"""
+    return path.read_text()
+
+
 class ManualOverrides(Rule):
     @staticmethod
     def match(drv, drv_log, opts, _rules_here):
@@ -769,11 +940,11 @@ class ManualOverrides(Rule):
         # no need for version searching here. If you need to reuse the rules for other versions
         # drop a symlink.
         p = manual_rule_path / pkg / version / "default.nix"
+        present = p in list_manual_override_folder(p.parent)
         log.debug(
-            f"Manual path would be {p} "
-            + ("(present)" if p.exists() else "(not present)")
+            "Manual path would be %s (%s)", p, "present" if present else "not present"
         )
-        if (manual_rule_path / pkg / version / "default.nix").exists():
+        if present:
             return "__file__:" + pkg + "/" + version + "/default.nix"
         return None
 
@@ -790,7 +961,7 @@ class ManualOverrides(Rule):
             )
         if opts.startswith("__file__:"):
             fn = opts[len("__file__:") :]
-            return RuleFunctionOutput((manual_rule_path / fn).read_text())
+            return RuleFunctionOutput(read_manual_override(manual_rule_path / fn))
         else:
             return None
 
@@ -799,15 +970,11 @@ class ManualOverrideAdditionalFiles(Rule):
     @staticmethod
     def match(drv, drv_log, opts, _rules_here):
         pkg, version = drv_to_pkg_and_version(drv)
-        try:
-            files = [
-                x
-                for x in (manual_rule_path / pkg / version).glob("*")
-                if x.name != "default.nix"
-            ]
-            return files
-        except FileNotFoundError:
-            return None
+        return [
+            x
+            for x in list_manual_override_folder(manual_rule_path / pkg / version)
+            if x.name != "default.nix"
+        ]
 
     def apply(opts):
         if opts:
@@ -817,10 +984,8 @@ class ManualOverrideAdditionalFiles(Rule):
 class MissingEmptyFiles(Rule):
     @staticmethod
     def match(drv, drv_log, opts, _rules_here):
-        if hits := re.findall(
-            "No such file or directory: '([^']*(requirements.txt))'", drv_log
-        ):
-            return [x[0] for x in hits]
+        if files := missing_requirements_txt_re.findall(drv_log):
+            return files
 
     @staticmethod
     def apply(opts):
@@ -832,9 +997,11 @@ class MissingEmptyFiles(Rule):
 
 
 class VersioneerBitRot(Rule):
-    @staticmethod
-    def match(drv, drv_log, opts, _rules_here):
-        if "module 'configparser' has no attribute 'SafeConfigParser'." in drv_log:
+    triggers = ("module 'configparser' has no attribute 'SafeConfigParser'.",)
+
+    @classmethod
+    def match(cls, drv, drv_log, opts, _rules_here):
+        if scan_log(drv_log).any(cls.triggers):
             return True
 
     @staticmethod
@@ -883,12 +1050,13 @@ class VersioneerBitRot(Rule):
 
 
 class RefindBuildDirectory(Rule):
-    @staticmethod
-    def match(drv, drv_log, opts, _rules_here):
-        return (
-            "does not appear to be a Python project: no pyproject.toml or setup.py"
-            in drv_log
-        )
+    triggers = (
+        "does not appear to be a Python project: no pyproject.toml or setup.py",
+    )
+
+    @classmethod
+    def match(cls, drv, drv_log, opts, _rules_here):
+        return scan_log(drv_log).any(cls.triggers)
 
     @staticmethod
     def apply(opts):
@@ -906,12 +1074,11 @@ class RefindBuildDirectory(Rule):
 
 
 class Torch(Rule):
-    @staticmethod
-    def match(drv, drv_log, opts, _rules_here):
-        return (
-            "libc10_cuda.so -> not found!" in drv_log
-            or "libtorch.so -> not found!" in drv_log
-        )
+    triggers = ("libc10_cuda.so -> not found!", "libtorch.so -> not found!")
+
+    @classmethod
+    def match(cls, drv, drv_log, opts, _rules_here):
+        return scan_log(drv_log).any(cls.triggers)
 
     @staticmethod
     def apply(opts):
@@ -928,11 +1095,16 @@ class Torch(Rule):
 
 
 class DowngradeSetupTools(Rule):
+    triggers = (
+        "TypeError: canonicalize_version() got an unexpected keyword argument 'strip_trailing_zero'",
+    )
+
     @staticmethod
     def match(drv, drv_log, opts, _rules_here):
+        hits = scan_log(drv_log)
         if (
             "TypeError: canonicalize_version() got an unexpected keyword argument 'strip_trailing_zero'"
-            in drv_log
+            in hits
         ):
             return "<71"
 
@@ -942,9 +1114,12 @@ class DowngradeSetupTools(Rule):
 
 
 class DowngradePytestRunner(Rule):
+    triggers = ("pytest-runner<5.0",)
+
     @staticmethod
     def match(drv, drv_log, opts, _rules_here):
-        if "pytest-runner<5.0" in drv_log:
+        hits = scan_log(drv_log)
+        if "pytest-runner<5.0" in hits:
             return "<5.0"
 
     @staticmethod
@@ -955,36 +1130,54 @@ class DowngradePytestRunner(Rule):
 class DowngradeNumpy(Rule):
     """Downgrade numpy when it's a clear >= 2.0 not suppported case"""
 
+    triggers = (
+        "'int_t' is not a type identifier",
+        "np.int_t",
+        "No module named 'numpy.distutils'",
+        " double I = intensity(",
+        " numpy/arrayobject.h: No such file",
+        "struct _PyArray_Descr",
+        "has no member named",
+        "subarray",
+        'origin = find_spec("numpy").origin',
+        "AttributeError: 'NoneType' object has no attribute 'origin",
+        "error: request for member ‘imag’ in something not a structure or union",
+        "_PyArray_Descr",
+        " has no member named",
+        "names",
+    )
+
     @staticmethod
     def match(drv, drv_log, opts, _rules_here):
-        if "'int_t' is not a type identifier" in drv_log and "np.int_t" in drv_log:
+        hits = scan_log(drv_log)
+        if "'int_t' is not a type identifier" in hits and "np.int_t" in hits:
             return "<2"
-        elif "No module named 'numpy.distutils'" in drv_log:
+        elif "No module named 'numpy.distutils'" in hits:
             return "<1.22"
-        elif " double I = intensity(" in drv_log:
+        elif " double I = intensity(" in hits:
             return "<1.22"
-        elif " numpy/arrayobject.h: No such file" in drv_log:
+        elif " numpy/arrayobject.h: No such file" in hits:
             return "<1.22"
         elif (
-            "struct _PyArray_Descr" in drv_log
-            and "has no member named" in drv_log
-            and "subarray" in drv_log
+            "struct _PyArray_Descr" in hits
+            and "has no member named" in hits
+            and "subarray" in hits
         ):
             return "<2"  # https://github.com/piskvorky/gensim/issues/3541
         elif (
-            'origin = find_spec("numpy").origin' in drv_log
-            and "AttributeError: 'NoneType' object has no attribute 'origin" in drv_log
+            'origin = find_spec("numpy").origin' in hits
+            and "AttributeError: 'NoneType' object has no attribute 'origin" in hits
         ):
             return "<2"
         elif (
             "error: request for member ‘imag’ in something not a structure or union"
-            in drv_log
+            in hits
         ):
             return "<2"
         elif (
-            "_PyArray_Descr" in drv_log
-            and " has no member named" in drv_log
-            and "names" in drv_log
+            "_PyArray_Descr" in hits
+            and " has no member named" in hits
+            and "names" in hits
         ):
             return "<2"
 
@@ -1001,39 +1194,64 @@ class DowngradePython(Rule):
     """Downgrade python if necessary"""
 
     # always_reapply = True  # otherwise we don't apply it if we already had the rule.
+    triggers = (
+        "3.12",
+        "No module named 'distutils'",
+        "greenlet-1.1.0",
+        "return kh_float64_hash_func(val.real)^kh_float64_hash_func(val.imag);",
+        "ModuleNotFoundError: No module named 'distutils'",
+        "fatal error: longintrepr.h: ",
+        "AttributeError: fcompiler. Did you mean: 'compiler'?",
+        "ModuleNotFoundError: No module named 'imp'",
+        "only versions >=3.6,<3.10 are supported.",
+        "Cannot install on Python version 3.10.",
+        "Cannot install on Python version ",
+        "only versions >=3.8,<3.12",
+        "cannot import name 'build_py_2to3' from 'distutils",
+        "ModuleNotFoundError: No module named 'distutils.msvccompiler'",
+        "requires python >= 3.6 and <=3.10",
+        "eval.h: No such file",
+        "_PyUnicode_get_wstr_length(PyObject *op)",
+        "PyArray_Descr’} has no member named ‘subarray’",
+        "invalid literal for int() with base 10:",
+        "in python_version",
+        "ModuleNotFoundError: No module named 'symbol'",
+        "‘PyLongObject’ {aka ‘struct _longobject’} has no member named ‘ob_digit’",
+    )
 
     @staticmethod
     def match(drv, drv_log, opts, _rules_here):
-        if "3.12" in drv_log and "No module named 'distutils'" in drv_log:
+        hits = scan_log(drv_log)
+        if "3.12" in hits and "No module named 'distutils'" in hits:
             log.error("Downgrading Python - distutils")
             return "3.10"
-        if "greenlet-1.1.0" in drv_log:
+        if "greenlet-1.1.0" in hits:
             log.error("Downgrading Python - greenlet")
             return "3.10"
         if (
             "return kh_float64_hash_func(val.real)^kh_float64_hash_func(val.imag);"
-            in drv_log
+            in hits
         ):
             log.error("Downgrading Python - old pandas")
             return "3.10"  # old pandas 1.5.3
-        if "ModuleNotFoundError: No module named 'distutils'" in drv_log:
+        if "ModuleNotFoundError: No module named 'distutils'" in hits:
             return "3.11"
-        if "fatal error: longintrepr.h: " in drv_log:
+        if "fatal error: longintrepr.h: " in hits:
             log.error("Downgrading Python - longinterpr")
             return "3.10"
-        if "AttributeError: fcompiler. Did you mean: 'compiler'?" in drv_log:
+        if "AttributeError: fcompiler. Did you mean: 'compiler'?" in hits:
             # that's trying to compile numpy 1.22, o
             log.error("Downgrading Python - fcompiler")
             return "3.10"
-        if "ModuleNotFoundError: No module named 'imp'" in drv_log:
+        if "ModuleNotFoundError: No module named 'imp'" in hits:
             return "3.11"
-        if "only versions >=3.6,<3.10 are supported." in drv_log:
+        if "only versions >=3.6,<3.10 are supported." in hits:
             return "3.9"
-        if "Cannot install on Python version 3.10." in drv_log:
+        if "Cannot install on Python version 3.10." in hits:
             return "3.9"
         if (
-            "Cannot install on Python version " in drv_log
-            and "only versions >=3.8,<3.12" in drv_log
+            "Cannot install on Python version " in hits
+            and "only versions >=3.8,<3.12" in hits
         ):
             return "3.11"
         if "pygame" in drv:
@@ -1041,31 +1259,31 @@ class DowngradePython(Rule):
             version = pkg_tuple[1]
             if Version(version) <= Version("2.5.2"):
                 return "3.11"
-        if "cannot import name 'build_py_2to3' from 'distutils" in drv_log:
+        if "cannot import name 'build_py_2to3' from 'distutils" in hits:
             return "3.9"
-        if "ModuleNotFoundError: No module named 'distutils.msvccompiler'" in drv_log:
+        if "ModuleNotFoundError: No module named 'distutils.msvccompiler'" in hits:
             return "3.9"  # old scipy
-        if "requires python >= 3.6 and <=3.10" in drv_log:
+        if "requires python >= 3.6 and <=3.10" in hits:
             return "3.9"
-        if "eval.h: No such file" in drv_log:
+        if "eval.h: No such file" in hits:
             log.error("Downgrading Python - eval.h")
             return "3.10"
-        if "_PyUnicode_get_wstr_length(PyObject *op)" in drv_log:
+        if "_PyUnicode_get_wstr_length(PyObject *op)" in hits:
             log.error("Downgrading Python - _PyUnicode_get_wstr_length")
             return "3.9"
-        if "PyArray_Descr’} has no member named ‘subarray’" in drv_log:
+        if "PyArray_Descr’} has no member named ‘subarray’" in hits:
             log.error("Downgrading Python - PyArray_Descr")
             return "3.10"
         if (
-            "invalid literal for int() with base 10:" in drv_log
-            and "in python_version" in drv_log
+            "invalid literal for int() with base 10:" in hits
+            and "in python_version" in hits
         ):  # pmisc - but get's excluded by 'max python = 3.8' anyway.
             return "3.9"
-        if "ModuleNotFoundError: No module named 'symbol'" in drv_log:
+        if "ModuleNotFoundError: No module named 'symbol'" in hits:
             return "3.9"
         if (
             "‘PyLongObject’ {aka ‘struct _longobject’} has no member named ‘ob_digit’"
-            in drv_log
+            in hits
         ):
             log.error("Downgrading Python - ob_digit")
             return "3.11"
@@ -1077,42 +1295,56 @@ class DowngradePython(Rule):
 
 
 class IsPython2Only(Rule):
+    triggers = (
+        "is Python 2 only.",
+        "PyFloat_FromString(str, NULL);",
+        "NameError: name 'execfile' is not defined",
+        "Missing dependencies",
+        "nose",
+        "NameError: name 'file' is not defined",
+        "except OSError, e:",
+        "print '",
+        'print "',
+        "raise exc, ",
+        "raise my_exception, ",
+        "raise newexc, None, sys.exc_info()",
+        "cannot import name 'quote' from 'urllib'",
+        "SyntaxError: invalid hexadecimal literal",
+    )
+
     @staticmethod
     def match(drv, drv_log, opts, _rules_here):
-        if "is Python 2 only." in drv_log:
-            pkg_tuple = drv_to_pkg_and_version(drv)
+        hits = scan_log(drv_log)
+        pkg_tuple = drv_to_pkg_and_version(drv)
+        if "is Python 2 only." in hits:
             return f"Is_python2_only: {pkg_tuple}"
         if (
-            "PyFloat_FromString(str, NULL);" in drv_log
+            "PyFloat_FromString(str, NULL);" in hits
         ):  # points to a long long ago c api.
-            pkg_tuple = drv_to_pkg_and_version(drv)
             return f"Is_python2_only (from c code): {pkg_tuple}"
-        if "NameError: name 'execfile' is not defined" in drv_log:
-            pkg_tuple = drv_to_pkg_and_version(drv)
+        if "NameError: name 'execfile' is not defined" in hits:
             return f"Is_python2_only (uses execfile): {pkg_tuple}"
-        if "Missing dependencies" in drv_log and "nose" in drv_log:
-            return f"Is_python2_only (required nose): {drv_to_pkg_and_version(drv)}"
-        if "NameError: name 'file' is not defined" in drv_log:
-            return (
-                f"Is_python2_only (file is not defined): {drv_to_pkg_and_version(drv)}"
-            )
-        if "except OSError, e:" in drv_log:
-            return f"Is_python2_only (except OSError, e): {drv_to_pkg_and_version(drv)}"
-        if "print '" in drv_log or 'print "' in drv_log:
-            return f"Is_python2_only (print '): {drv_to_pkg_and_version(drv)}"
-        if re.search("except [^,]+,[^:]+:", drv_log):
-            return f"Is_python2_only (except x, y:): {drv_to_pkg_and_version(drv)}"
+        if "Missing dependencies" in hits and "nose" in hits:
+            return f"Is_python2_only (required nose): {pkg_tuple}"
+        if "NameError: name 'file' is not defined" in hits:
+            return f"Is_python2_only (file is not defined): {pkg_tuple}"
+        if "except OSError, e:" in hits:
+            return f"Is_python2_only (except OSError, e): {pkg_tuple}"
+        if "print '" in hits or 'print "' in hits:
+            return f"Is_python2_only (print '): {pkg_tuple}"
+        if python2_except_re.search(drv_log):
+            return f"Is_python2_only (except x, y:): {pkg_tuple}"
         # todo: this needs a regexp
         if (
-            "raise exc, " in drv_log
-            or "raise my_exception, " in drv_log
-            or "raise newexc, None, sys.exc_info()" in drv_log
+            "raise exc, " in hits
+            or "raise my_exception, " in hits
+            or "raise newexc, None, sys.exc_info()" in hits
         ):
-            return f"Is_python2_only (raise exec,): {drv_to_pkg_and_version(drv)}"
-        if "cannot import name 'quote' from 'urllib'" in drv_log:
-            return f"Is_python2_only (looks for urllib.quote): {drv_to_pkg_and_version(drv)}"
-        if "SyntaxError: invalid hexadecimal literal" in drv_log and "0xFFFFFFFAL":
-            return f"Is_python2_only (long int, 0xFFFFFFFAL): {drv_to_pkg_and_version(drv)}"
+            return f"Is_python2_only (raise exec,): {pkg_tuple}"
+        if "cannot import name 'quote' from 'urllib'" in hits:
+            return f"Is_python2_only (looks for urllib.quote): {pkg_tuple}"
+        if "SyntaxError: invalid hexadecimal literal" in hits and "0xFFFFFFFAL":
+            return f"Is_python2_only (long int, 0xFFFFFFFAL): {pkg_tuple}"
 
     @staticmethod
     def apply(opts):
@@ -1120,9 +1352,12 @@ class IsPython2Only(Rule):
 
 
 class PyPIStub(Rule):
+    triggers = ("wrong pypi",)
+
     @staticmethod
     def match(drv, drv_log, opts, _rules_here):
-        if "wrong pypi" in drv_log:
+        hits = scan_log(drv_log)
+        if "wrong pypi" in hits:
             pkg_tuple = drv_to_pkg_and_version(drv)
             return f"Not actually on pypi/stub only: {pkg_tuple}"
 
@@ -1132,14 +1367,20 @@ class PyPIStub(Rule):
 
 
 class Rust(Rule):
+    triggers = (
+        "setuptools_rust",
+        "maturin",
+    )
+
     @classmethod
     def match(cls, drv, drv_log, opts, rules_here):
+        hits = scan_log(drv_log)
         result = None
-        if "setuptools_rust" in drv_log or "setuptools-rust" in rules_here.get(
+        if "setuptools_rust" in hits or "setuptools-rust" in rules_here.get(
             "BuildSystems", []
         ):
             result = "setuptools_rust"
-        elif "maturin" in drv_log or "maturin" in rules_here.get("BuildSystems", []):
+        elif "maturin" in hits or "maturin" in rules_here.get("BuildSystems", []):
             result = "maturin"
         return result
 
@@ -1188,40 +1429,60 @@ class Rust(Rule):
     def build_missing_cargo_lock(drv, src):
         pkg, version = drv_to_pkg_and_version(drv)
         log.info(f"Creating a missing Cargo.lock for {pkg}-{version}")
-        tf = tempfile.TemporaryDirectory(delete=True)
-        extract_source(src, tf.name)
-        cargo_tomls = list(Path(tf.name).rglob("Cargo.toml"))
-        if not cargo_tomls:
+        # the member list is cached, unpacking is not - don't unpack for nothing
+        if src.endswith(".tar.gz") and not any(
+            fn.rsplit("/", 1)[-1] == "Cargo.toml" for fn in tar_member_names(src)
+        ):
             raise ValueError("No Cargo.toml found")
-        cargo_tomls.sort(
-            key=lambda x: len(str(x))
-        )  # shortest path first, just like search_and_extract_from_archive
-        cargo_toml = cargo_tomls[0]
-        p = subprocess.Popen(
-            [
-                "nix",
-                "shell",
-                "github:/nixos/nixpkgs/master#cargo",
-                "-c",
-                "cargo",
-                "check",
-            ],
-            cwd=cargo_toml.parent,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-        )
-        stdout, stderr = p.communicate()
-        if p.returncode != 0:
-            raise ValueError(f"cargo check failed: {stderr.decode('utf-8')}")
-        return (cargo_toml.with_name("Cargo.lock")).read_text()
+        with tempfile.TemporaryDirectory() as tf:
+            extract_source(src, tf)
+            cargo_toml = find_shallowest(tf, "Cargo.toml")
+            if cargo_toml is None:
+                raise ValueError("No Cargo.toml found")
+            cargo_bin = cargo_bin_folder()
+            p = subprocess.Popen(
+                [cargo_bin / "cargo", "check"],
+                cwd=cargo_toml.parent,
+                env={
+                    **os.environ,
+                    "PATH": f"{cargo_bin}:{os.environ.get('PATH', '')}",
+                },
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+            )
+            stdout, stderr = p.communicate()
+            if p.returncode != 0:
+                raise ValueError(f"cargo check failed: {stderr.decode('utf-8')}")
+            return (cargo_toml.with_name("Cargo.lock")).read_text()
+
+
+@functools.cache
+def cargo_bin_folder():
+    """bin/ of nixpkgs' cargo - evaluated and realised once per run, not per Cargo.lock"""
+    out_path = subprocess.check_output(
+        [
+            "nix",
+            "build",
+            "--no-link",
+            "--print-out-paths",
+            "github:/nixos/nixpkgs/master#cargo",
+        ],
+        text=True,
+    ).split()[0]
+    return Path(out_path) / "bin"
 
 
 class MaturinBitRot(Rule):
+    triggers = (
+        "The following metadata fields in `package.metadata.maturin` section of Cargo.toml are removed since maturin 0.14.0",
+    )
+
     @staticmethod
     def match(drv, drv_log, opts, rules_here):
+        hits = scan_log(drv_log)
         if (
             "The following metadata fields in `package.metadata.maturin` section of Cargo.toml are removed since maturin 0.14.0"
-            in drv_log
+            in hits
         ):
             src = get_src(drv)
             cargo_toml_path = search_in_archive(src, "Cargo.toml")
@@ -1240,9 +1501,12 @@ class MaturinBitRot(Rule):
 
 
 class Enum34(Rule):  # a older variant of PythonTooNew
+    triggers = ("module 'enum' has no attribute 'global_enum'",)
+
     @staticmethod
     def match(drv, drv_log, opts, _rules_here):
-        if "module 'enum' has no attribute 'global_enum'" in drv_log:
+        hits = scan_log(drv_log)
+        if "module 'enum' has no attribute 'global_enum'" in hits:
             return f"Requires enum34, a pre python 3.6 thing."
 
     @staticmethod
@@ -1250,41 +1514,32 @@ class Enum34(Rule):  # a older variant of PythonTooNew
         return RuleOutputTriggerExclusion(opts)
 
 
+# log needle -> why we exclude the package (str.format'ed with pkg_tuple).
+# First hit wins, in this order
+python_too_new_signatures = {
+    "type object 'Callable' has no attribute '_abc_registry'": "requires pypi typing, but typing has been built in since 3.6",
+    "sqlcipher/sqlite3.h:": "requires sqlcipher, which is disabled since python 3.9",
+    "module 'typing' has no attribute '_ClassVar'": "requires dataclasses from pypi (so python before 3.6)",
+    "This backport is meant only for Python 2.": "This backport is meant only for Python 2. {pkg_tuple}",
+    " error: invalid use of incomplete typedef ‘PyInterpreterState": "invalid use of incomplete typedef ‘PyInterpreterState’ (python <3.8?)",
+    "Supported interpreter versions: 3.5, 3.6, 3.7, 3.8\n": "Supported interpreter versions: 3.5, 3.6, 3.7, 3.8: {pkg_tuple}",
+    "AttributeError: module 'distutils.util' has no attribute 'run_2to3'": "distutils.util has no run_2to3: {pkg_tuple}",
+    "setup command: use_2to3 is invalid.": "setuptools too new, setup command: use_2to3 is invalid. {pkg_tuple}",
+    "AttributeError: module 'platform' has no attribute 'dist'": "AttributeError: module 'platform' has no attribute 'dist'",
+}
+
+
 class PythonTooNew(Rule):
     # and we need to exclude this from our builds
     # see DowngradePython for the other case
+    triggers = tuple(python_too_new_signatures)
+
     @staticmethod
     def match(drv, drv_log, opts, _rules_here):
-        if "type object 'Callable' has no attribute '_abc_registry'" in drv_log:
-            return f"requires pypi typing, but typing has been built in since 3.6"
-        if "sqlcipher/sqlite3.h:" in drv_log:
-            return f"requires sqlcipher, which is disabled since python 3.9"
-        if "module 'typing' has no attribute '_ClassVar'" in drv_log:
-            return "requires dataclasses from pypi (so python before 3.6)"
-        if "This backport is meant only for Python 2." in drv_log:
-            pkg_tuple = drv_to_pkg_and_version(drv)
-            return "This backport is meant only for Python 2. {pkg_tuple}"
-        if " error: invalid use of incomplete typedef ‘PyInterpreterState" in drv_log:
-            return (
-                "invalid use of incomplete typedef ‘PyInterpreterState’ (python <3.8?)"
-            )
-        if "Supported interpreter versions: 3.5, 3.6, 3.7, 3.8\n" in drv_log:
-            pkg_tuple = drv_to_pkg_and_version(drv)
-            return f"Supported interpreter versions: 3.5, 3.6, 3.7, 3.8: {pkg_tuple}"
-        if (
-            "AttributeError: module 'distutils.util' has no attribute 'run_2to3'"
-            in drv_log
-        ):
-            pkg_tuple = drv_to_pkg_and_version(drv)
-            return f"distutils.util has no run_2to3: {pkg_tuple}"
-        if "setup command: use_2to3 is invalid." in drv_log:
-            pkg_tuple = drv_to_pkg_and_version(drv)
-            return (
-                f"setuptools too new, setup command: use_2to3 is invalid. {pkg_tuple}"
-            )
-        if "AttributeError: module 'platform' has no attribute 'dist'" in drv_log:
-            pkg_tuple = drv_to_pkg_and_version(drv)
-            return "AttributeError: module 'platform' has no attribute 'dist'"
+        hits = scan_log(drv_log)
+        for needle, reason in python_too_new_signatures.items():
+            if needle in hits:
+                return reason.format(pkg_tuple=drv_to_pkg_and_version(drv))
 
     @staticmethod
     def apply(opts):
@@ -1292,9 +1547,12 @@ class PythonTooNew(Rule):
 
 
 class MacOnly(Rule):
+    triggers = ("PyObjC requires macOS to build",)
+
     @staticmethod
     def match(drv, drv_log, opts, _rules_here):
-        if "PyObjC requires macOS to build" in drv_log:
+        hits = scan_log(drv_log)
+        if "PyObjC requires macOS to build" in hits:
             pkg_tuple = drv_to_pkg_and_version(drv)
             return f"PyObjC requires macOS to build: {pkg_tuple}"
 
@@ -1304,11 +1562,14 @@ class MacOnly(Rule):
 
 
 class QTDontWrap(Rule):
+    triggers = ("Error: wrapQtAppsHook is not used, and dontWrapQtApps is not set.",)
+
     @staticmethod
     def match(drv, drv_log, opts, _rules_here):
+        hits = scan_log(drv_log)
         return (
             "Error: wrapQtAppsHook is not used, and dontWrapQtApps is not set."
-            in drv_log
+            in hits
         )
 
     @staticmethod
@@ -1330,23 +1591,17 @@ class MissingSetParts:
     def match(drv, drv_log, opts, _rules_here):
         if opts is None:
             opts = {}
-        if re.search("attribute '[^']+' missing", drv_log):
+        if attribute_missing_re.search(drv_log):
             log.warn("Missing attribute in derivation - trying to patch it in")
             # I am looking for final.something where in the next line there's a ^ pointing at it.
-            for hit in re.finditer("final\\.[a-z0-9A-Z-]+", drv_log):
-                log.debug(f"Found a hit {hit}")
-                last_newline = max(0, drv_log.rfind("\n", 0, hit.span()[0]) + 1)
-                next_newline = drv_log.find("\n", hit.span()[1])
-                this_line = drv_log[last_newline:next_newline]
-                eol = drv_log.find("\n", next_newline + 1)
-                if eol == -1:
-                    eol = None
-                next_line = drv_log[next_newline + 1 : eol]
-                caret_pos = next_line.find("^")
-                if hit.span()[0] - last_newline == caret_pos:
-                    log.info("Hit hat a caret (^) on it")
-                    text = drv_log[hit.span()[0] : hit.span()[1]][6:]
-                    opts[text] = ""
+            lines = drv_log.split("\n")
+            for line, next_line in zip(lines, lines[1:]):
+                for hit in final_attribute_re.finditer(line):
+                    log.debug("Found a hit %s", hit)
+                    if hit.start() == next_line.find("^"):
+                        log.info("Hit hat a caret (^) on it")
+                        text = hit.group()[6:]
+                        opts[text] = ""
         if opts:
             return opts
 
@@ -1356,9 +1611,11 @@ class MissingSetParts:
 
 
 class KernelHeaders(Rule):
+    triggers = ("apt-get install linux-headers",)
+
     @staticmethod
     def match(drv, drv_log, opts, _rules_here):
-        return "apt-get install linux-headers" in drv_log
+        return "apt-get install linux-headers" in scan_log(drv_log)
 
     @staticmethod
     def apply(opts):
@@ -1376,9 +1633,11 @@ class KernelHeaders(Rule):
 
 
 class Udunits(Rule):
+    triggers = ("Require to set UDUNITS2_XML_PATH",)
+
     @staticmethod
     def match(drv, drv_log, opts, _rules_here):
-        return "Require to set UDUNITS2_XML_PATH" in drv_log
+        return "Require to set UDUNITS2_XML_PATH" in scan_log(drv_log)
 
     @staticmethod
     def apply(opts):
@@ -1393,9 +1652,11 @@ class Udunits(Rule):
 
 
 class HomlessShelter(Rule):
+    triggers = ("Permission denied: '/homeless-shelter'",)
+
     @staticmethod
     def match(drv, drv_log, opts, _rules_here):
-        return "Permission denied: '/homeless-shelter'" in drv_log
+        return "Permission denied: '/homeless-shelter'" in scan_log(drv_log)
 
     @staticmethod
     def apply(opts):
@@ -1436,10 +1697,13 @@ class NvidiaCollision(Rule):
 
 
 class HD5DIR(Rule):
+    triggers = ("You may need to explicitly state where your local HDF5 headers",)
+
     @staticmethod
     def match(drv, drv_log, opts, _rules_here):
+        hits = scan_log(drv_log)
         return (
-            "You may need to explicitly state where your local HDF5 headers" in drv_log
+            "You may need to explicitly state where your local HDF5 headers" in hits
         )
 
     @staticmethod
@@ -1461,9 +1725,11 @@ class HD5DIR(Rule):
 
 
 class UnpackerNoDirectories(Rule):
+    triggers = ("unpacker appears to have produced no directories",)
+
     @staticmethod
     def match(drv, drv_log, opts, _rules_here):
-        return "unpacker appears to have produced no directories" in drv_log
+        return "unpacker appears to have produced no directories" in scan_log(drv_log)
 
     @staticmethod
     def apply(opts):
@@ -1476,3 +1742,17 @@ class UnpackerNoDirectories(Rule):
                 ''""")
             },
         )
+
+
+@functools.cache
+def all_rules():
+    """All (name, rule class) pairs, sorted by name.
+
+    Order matters - some rules look at what earlier rules decided in rules_here
+    (e.g. Rust after BuildSystems), and that order has always been dir(rules).
+    """
+    return tuple(
+        (name, obj)
+        for name, obj in sorted(globals().items())
+        if isinstance(obj, type) and issubclass(obj, Rule) and obj is not Rule
+    )